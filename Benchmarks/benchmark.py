@@ -0,0 +1,153 @@
+"""
+Benchmarks the logic layer of the Blockmatching module on synthetic phantoms.
+
+Run it without the Slicer GUI:
+
+    Slicer --no-main-window --python-script Benchmarks/benchmark.py -- --fake
+
+The export, header validation, process and loading phases are measured
+separately, as well as the peak memory of Slicer and of the blockmatching
+process. With --fake, blockmatching is replaced by fake_blockmatching.py so
+that only the Python overhead is measured.
+
+Each case is appended as a JSON line to the output file, with the current
+commit, so that results can be compared across commits.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import datetime
+import subprocess
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+import numpy as np
+import slicer
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARKS_DIR)
+sys.path.insert(0, REPO_DIR)
+
+from Blockmatching import BlockmatchingLogic, BlockmatchingParameters, RegistrationJob, BLOCKMATCHING_PATH
+
+
+FAKE_BLOCKMATCHING_PATH = os.path.join(BENCHMARKS_DIR, 'fake_blockmatching.py')
+
+
+def getArguments():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes3d', type=int, nargs='*', default=[64, 256, 512])
+    parser.add_argument('--sizes2d', type=int, nargs='*', default=[256, 1024])
+    parser.add_argument('--transformation', default='affine')
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--fake', action='store_true',
+                        help='use fake_blockmatching.py instead of blockmatching')
+    parser.add_argument('--blockmatching', default=BLOCKMATCHING_PATH)
+    parser.add_argument('--output', default=os.path.join(slicer.app.temporaryPath, 'blockmatching_benchmarks.jsonl'))
+    return parser.parse_args()
+
+
+def getCommit():
+    try:
+        output = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR)
+        return output.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def getMaxRSS():
+    if resource is None: return None
+    maxRSS = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxRSS * 1024 if sys.platform.startswith('linux') else maxRSS  # kB on Linux
+
+
+def makePhantom(shape, shift=0):
+    """
+    Noisy ellipsoid, shifted along the last axis
+    """
+    grids = np.ogrid[tuple(slice(0, n) for n in shape)]
+    distance = np.zeros(shape, np.float32)
+    for grid, n in zip(grids, shape):
+        if n == 1: continue
+        distance = distance + ((grid - n / 2.) / (n / 3.)) ** 2
+    phantom = np.where(distance < 1, 1000, 100).astype(np.int16)
+    phantom += np.random.RandomState(0).randint(0, 50, size=shape).astype(np.int16)
+    return np.roll(phantom, shift, axis=-1)
+
+
+def runCase(logic, shape, trsfType, outputDirectory):
+    reference = slicer.util.addVolumeFromArray(makePhantom(shape), name='reference')
+    floating = slicer.util.addVolumeFromArray(makePhantom(shape, shift=shape[-1] // 20), name='floating')
+
+    def timeValidation(job):
+        """
+        Cold header validation of the exported inputs, before the batch
+        might remove them
+        """
+        if job.status != 'done': return
+        logic.niftiHeaderCache = {}
+        tIni = time.time()
+        for path in job.referencePath, job.floatingPath:
+            logic.readNIFTIHeader(path)
+        job.record['phases']['validation'] = time.time() - tIni
+
+    try:
+        job = RegistrationJob(reference, floating)
+        logic.registerBatch([job],
+                            parameters=BlockmatchingParameters(trsfType=trsfType),
+                            maxProcesses=1,
+                            outputDirectory=outputDirectory,
+                            onJobFinished=timeValidation,
+                            useCache=False,
+                            wait=True)
+        return job
+    finally:
+        for node in reference, floating, job.resultTransformNode:
+            if node is not None:
+                slicer.mrmlScene.RemoveNode(node)
+
+
+def main():
+    args = getArguments()
+    blockmatchingPath = FAKE_BLOCKMATCHING_PATH if args.fake else args.blockmatching
+    logic = BlockmatchingLogic(blockmatchingPath=blockmatchingPath)
+    outputDirectory = str(slicer.util.tempDirectory())
+    commit = getCommit()
+
+    shapes = [(n, n, n) for n in args.sizes3d] + [(1, n, n) for n in args.sizes2d]
+    for shape in shapes:
+        for _ in range(args.repeat):
+            maxRSSBefore = getMaxRSS()
+            job = runCase(logic, shape, args.transformation, outputDirectory)
+            result = {
+                'date': datetime.datetime.now().isoformat(),
+                'commit': commit,
+                'fake': args.fake,
+                'shape': shape,
+                'trsfType': args.transformation,
+                'status': job.status,
+                'phases': job.record['phases'],
+                'levels': job.record.get('levels'),
+                'processPeakRSSBytes': job.record.get('peakRSSBytes'),
+                'processCPUSeconds': job.record.get('cpuSeconds'),
+                'slicerMaxRSSBytesBefore': maxRSSBefore,
+                'slicerMaxRSSBytesAfter': getMaxRSS(),
+            }
+            with open(args.output, 'a') as f:
+                f.write(json.dumps(result) + '\n')
+
+            phases = ', '.join('{} {:.3f} s'.format(k, v) for k, v in sorted(result['phases'].items()))
+            print('{:>16} {}: {}'.format(' x '.join(str(n) for n in shape), job.status, phases))
+
+    print('Results appended to', args.output)
+
+
+main()
+slicer.app.exit()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+"""
+Stand-in for the blockmatching binary, used to measure the overhead of the
+module without the cost of an actual registration.
+
+It accepts the same command line as blockmatching and writes outputs with
+the expected formats: the floating image as result image, an identity
+matrix as linear transformation and a zero NIfTI displacement field as
+vectorfield transformation.
+
+Set FAKE_BLOCKMATCHING_SECONDS to simulate a registration time.
+Only the Python standard library is used.
+"""
+
+import os
+import sys
+import gzip
+import time
+import shutil
+import struct
+
+
+NIFTI_HEADER_SIZE = 348
+NIFTI_VOX_OFFSET = 352
+NIFTI_FLOAT32 = 16
+NIFTI_INTENT_DISPVECT = 1006
+
+
+def getArguments(argv):
+    arguments = {}
+    flag = None
+    for arg in argv[1:]:
+        if arg.startswith('-') and not isNumber(arg):
+            flag = arg
+            arguments[flag] = []
+        elif flag is not None:
+            arguments[flag].append(arg)
+    return arguments
+
+
+def isNumber(s):
+    try:
+        float(s)
+        return True
+    except ValueError:
+        return False
+
+
+def readNIFTIHeader(path):
+    openFile = gzip.open if path.endswith('.gz') else open
+    with openFile(path, 'rb') as f:
+        return bytearray(f.read(NIFTI_HEADER_SIZE))
+
+
+def copyImage(sourcePath, destinationPath):
+    if sourcePath.endswith('.gz') and not destinationPath.endswith('.gz'):
+        with gzip.open(sourcePath, 'rb') as fin, open(destinationPath, 'wb') as fout:
+            shutil.copyfileobj(fin, fout)
+    else:
+        shutil.copy(sourcePath, destinationPath)
+
+
+def writeIdentityMatrix(trsfPath):
+    lines = ['(', '08']
+    for row in range(4):
+        lines.append(''.join('{:13.8f}'.format(float(row == col)) for col in range(4)))
+    lines.append(')')
+    with open(trsfPath, 'w') as f:
+        f.write('\n'.join(lines))
+
+
+def writeZeroDisplacementField(referencePath, fieldPath):
+    header = readNIFTIHeader(referencePath)
+    dim = list(struct.unpack_from('<8h', header, 40))
+    sizes = [max(1, n) for n in dim[1:4]]
+    dim = [5] + sizes + [1, 3, 1, 1]
+    struct.pack_into('<8h', header, 40, *dim)
+    struct.pack_into('<h', header, 68, NIFTI_INTENT_DISPVECT)
+    struct.pack_into('<2h', header, 70, NIFTI_FLOAT32, 32)
+    struct.pack_into('<f', header, 108, NIFTI_VOX_OFFSET)
+    struct.pack_into('<2f', header, 112, 1, 0)  # scl_slope, scl_inter
+    header[344:348] = b'n+1\x00'
+
+    numberOfBytes = sizes[0] * sizes[1] * sizes[2] * 3 * 4
+    with open(fieldPath, 'wb') as f:
+        f.write(bytes(header))
+        f.write(b'\x00' * (NIFTI_VOX_OFFSET - NIFTI_HEADER_SIZE))
+        f.truncate(NIFTI_VOX_OFFSET + numberOfBytes)  # sparse zeros
+
+
+def main():
+    arguments = getArguments(sys.argv)
+    referencePath = arguments['-reference'][0]
+    floatingPath = arguments['-floating'][0]
+    resultPath = arguments['-result'][0]
+    resultTransformPath = arguments['-result-transformation'][0]
+    trsfType = arguments.get('-transformation-type', ['affine'])[0]
+    highestLevel = int(arguments.get('-pyramid-highest-level', [3])[0])
+    lowestLevel = int(arguments.get('-pyramid-lowest-level', [2])[0])
+
+    if '-command-line' in arguments:
+        with open(arguments['-command-line'][0], 'w') as f:
+            f.write(' '.join(sys.argv))
+
+    seconds = float(os.environ.get('FAKE_BLOCKMATCHING_SECONDS', 0))
+    levels = list(range(highestLevel, lowestLevel - 1, -1))
+    logLines = []
+    for level in levels:
+        tIni = time.time()
+        time.sleep(seconds / len(levels))
+        logLines.append('pyramid level #{}'.format(level))
+        logLines.append('elapsed time = {:.3f} sec'.format(time.time() - tIni))
+
+    copyImage(floatingPath, resultPath)
+    if trsfType == 'vectorfield':
+        writeZeroDisplacementField(referencePath, resultTransformPath)
+    else:
+        writeIdentityMatrix(resultTransformPath)
+
+    log = '\n'.join(logLines) + '\n'
+    sys.stdout.write(log)
+    if '-logfile' in arguments:
+        with open(arguments['-logfile'][0], 'w') as f:
+            f.write(log)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
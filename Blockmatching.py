@@ -1,20 +1,86 @@
 import os
+import gzip
+import json
+import hashlib
+import contextlib
 import time
+import struct
+import re
 import shutil
 import random
 import string
+import collections
+import platform
 import datetime
-import subprocess
+import multiprocessing
+import concurrent.futures
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
 
 import numpy as np
-import sitkUtils as su
 import SimpleITK as sitk
 import vtk, qt, ctk, slicer
 from slicer.ScriptedLoadableModule import *
 
 
-BLOCKMATCHING_PATH = os.path.expanduser('~/bin/blockmatching')
+BLOCKMATCHING_PATH = os.environ.get('BLOCKMATCHING_PATH', os.path.expanduser('~/bin/blockmatching'))
 TRANSFORMATIONS = ['Rigid', 'Similitude', 'Affine', 'Vectorfield']
+PARALLELISM_TYPES = ['default', 'none', 'openmp', 'pthread']
+OMP_SCHEDULINGS = ['default', 'static', 'dynamic-one', 'dynamic', 'guided']
+CASCADE_TRANSFORMATIONS = ['rigid', 'affine', 'vectorfield']
+PERFORMANCE_MODES = ['Default', 'Manual', 'Auto']
+EXPORT_CACHE_MAX_BYTES = 8 * 1024 ** 3
+HISTOGRAM_BINS = 256
+STATISTICS_CHUNK_VOXELS = 2 ** 24
+INRIMAGE_HEADER_BLOCK = 256
+HASH_CHUNK_BYTES = 2 ** 20
+RESULT_CACHE_DEFAULT_GB = 10
+COMPACT_DATA_TYPES = [np.uint8, np.int16, np.uint16]  # smallest first
+# Flags followed by a path whose content, not name, determines the results
+INPUT_PATH_FLAGS = ['-reference', '-floating', '-initial-transformation']
+# Flags that do not change the results
+OUTPUT_PATH_FLAGS = ['-result', '-result-transformation', '-command-line', '-logfile']
+PARALLELISM_FLAGS = ['-parallel', '-no-parallel']
+PARALLELISM_VALUE_FLAGS = ['-max-chunks', '-parallelism-type', '-omp-scheduling']
+HISTORY_FILENAME = 'blockmatching_history.jsonl'
+MONITOR_INTERVAL_MS = 500
+# blockmatching defaults, used to estimate the cost of each pyramid level
+BLOCK_SIZE = [4, 4, 4]
+BLOCK_SPACING = [3, 3, 3]
+BLOCK_BORDER = [0, 0, 0]
+SEARCH_NEIGHBORHOOD_HALF_SIZE = [3, 3, 3]
+SEARCH_NEIGHBORHOOD_STEP = [1, 1, 1]
+FLOATING_SELECTION_FRACTION = 0.5
+# Rough guess used until the history has timed levels
+DEFAULT_SECONDS_PER_COST = 2e-9
+DEFAULT_TIME_BUDGET_SECONDS = 60
+ROI_DEFAULT_MARGIN_MM = 10
+PREVIEW_DEFAULT_LEVEL = 2
+PREVIEW_DELAY_MS = 1000
+ROI_NODE_TYPES = ['vtkMRMLMarkupsROINode', 'vtkMRMLAnnotationROINode', 'vtkMRMLSegmentationNode']
+LOG_MAX_LINES = 10000  # ring buffer size for the process output
+LOG_DIALOG_LINES = 20
+LEVEL_PATTERN = re.compile(r'level\s*[#=:]?\s*(\d+)', re.IGNORECASE)
+ITERATION_PATTERN = re.compile(r'iteration\s*[#=:]?\s*(\d+)', re.IGNORECASE)
+NIFTI_HEADER_SIZE = 348
+NIFTI_VOX_OFFSET = 352
+NIFTI_XFORM_SCANNER_ANAT = 1
+NIFTI_UNITS_MM = 2
+NIFTI_DATA_TYPES = {
+    2: 'u1',
+    4: 'i2',
+    8: 'i4',
+    16: 'f4',
+    64: 'f8',
+    256: 'i1',
+    512: 'u2',
+    768: 'u4',
+    1024: 'i8',
+    1280: 'u8',
+}
 
 
 class Blockmatching(ScriptedLoadableModule):
@@ -47,6 +113,20 @@ class BlockmatchingWidget(ScriptedLoadableModuleWidget):
         self.onInputModified()
 
 
+    def cleanup(self):
+        self.removePreview()
+        self.viewUpdateTimer.stop()
+        if self.pendingViewUpdate is not None:
+            for engine in self.pendingViewUpdate[3]:
+                engine.writeHistory()
+            self.pendingViewUpdate = None
+        if self.engine is not None or self.cascade is not None:
+            self.onCancel()
+        if self.batch is not None and self.batch.isRunning():
+            self.batch.cancel()
+        self.logic.removeStatisticsObservers()
+
+
     def makeGUI(self):
         """
         Usage: blockmatching -reference|-ref %s -floating|-flo %s -result|-res %s
@@ -105,9 +185,94 @@ class BlockmatchingWidget(ScriptedLoadableModuleWidget):
         self.applyButton.clicked.connect(self.onApply)
         self.parent.layout().addWidget(self.applyButton)
 
+        self.makePreviewWidgets()
+        self.makeProgressWidgets()
+        self.makeLogButton()
+        self.makeBatchButton()
+        self.makePropagateButton()
+
         self.parent.layout().addStretch()
 
 
+    def makeProgressWidgets(self):
+        self.progressFrame = qt.QFrame()
+        progressLayout = qt.QHBoxLayout(self.progressFrame)
+        progressLayout.setContentsMargins(0, 0, 0, 0)
+
+        self.progressBar = qt.QProgressBar()
+        self.progressBar.setRange(0, 0)  # busy indicator
+        progressLayout.addWidget(self.progressBar)
+
+        self.cancelButton = qt.QPushButton('Cancel')
+        self.cancelButton.clicked.connect(self.onCancel)
+        progressLayout.addWidget(self.cancelButton)
+
+        self.progressFrame.hide()
+        self.parent.layout().addWidget(self.progressFrame)
+
+        self.engine = None
+        self.cascade = None
+
+
+    def makePreviewWidgets(self):
+        previewFrame = qt.QFrame()
+        previewLayout = qt.QHBoxLayout(previewFrame)
+        previewLayout.setContentsMargins(0, 0, 0, 0)
+
+        self.previewCheckBox = qt.QCheckBox('Preview at pyramid level')
+        self.previewCheckBox.setToolTip(
+            'Register downsampled images whenever the parameters change.'
+            ' Apply runs the same parameters at full resolution.')
+        self.previewCheckBox.toggled.connect(self.onPreviewToggled)
+        previewLayout.addWidget(self.previewCheckBox)
+
+        self.previewLevelSpinBox = qt.QSpinBox()
+        self.previewLevelSpinBox.minimum = 1
+        self.previewLevelSpinBox.maximum = 6
+        self.previewLevelSpinBox.value = PREVIEW_DEFAULT_LEVEL
+        self.previewLevelSpinBox.setAlignment(qt.Qt.AlignCenter)
+        self.previewLevelSpinBox.valueChanged.connect(self.schedulePreview)
+        previewLayout.addWidget(self.previewLevelSpinBox)
+
+        self.previewLabel = qt.QLabel()
+        previewLayout.addWidget(self.previewLabel)
+        previewLayout.addStretch()
+        self.parent.layout().addWidget(previewFrame)
+
+        # Debounce the changes of the parameters
+        self.previewTimer = qt.QTimer()
+        self.previewTimer.setSingleShot(True)
+        self.previewTimer.setInterval(PREVIEW_DELAY_MS)
+        self.previewTimer.timeout.connect(self.runPreview)
+
+        self.previewEngine = None
+        self.previewTransformNode = None
+        self.previewFloatingNode = None  # floating node the preview transform is applied to
+        self.previewFloatingTransformID = None  # its transform before the preview
+
+        # Coalesce the view updates after loading results
+        self.viewUpdateTimer = qt.QTimer()
+        self.viewUpdateTimer.setSingleShot(True)
+        self.viewUpdateTimer.setInterval(0)
+        self.viewUpdateTimer.timeout.connect(self.updateViews)
+        self.pendingViewUpdate = None
+
+
+    def makeLogButton(self):
+        self.logCollapsibleButton = ctk.ctkCollapsibleButton()
+        self.logCollapsibleButton.text = 'Log'
+        self.logCollapsibleButton.collapsed = True
+        self.layout.addWidget(self.logCollapsibleButton)
+
+        logLayout = qt.QVBoxLayout(self.logCollapsibleButton)
+
+        self.logTextEdit = qt.QPlainTextEdit()
+        self.logTextEdit.setReadOnly(True)
+        self.logTextEdit.setMaximumBlockCount(LOG_MAX_LINES)  # oldest lines are dropped
+        self.logTextEdit.setLineWrapMode(qt.QPlainTextEdit.NoWrap)
+        logLayout.addWidget(self.logTextEdit)
+
+
     def makeInputsButton(self):
         self.inputsCollapsibleButton = ctk.ctkCollapsibleButton()
         self.inputsCollapsibleButton.text = 'Inputs'
@@ -155,6 +320,27 @@ class BlockmatchingWidget(ScriptedLoadableModuleWidget):
         self.initialTransformSelector.currentNodeChanged.connect(self.onInputModified)
         self.inputsLayout.addRow("Initial transform: ", self.initialTransformSelector)
 
+        # Region of interest
+        self.roiSelector = slicer.qMRMLNodeComboBox()
+        self.roiSelector.nodeTypes = ROI_NODE_TYPES
+        self.roiSelector.selectNodeUponCreation = True
+        self.roiSelector.addEnabled = False
+        self.roiSelector.removeEnabled = True
+        self.roiSelector.noneEnabled = True
+        self.roiSelector.showHidden = False
+        self.roiSelector.showChildNodeTypes = True
+        self.roiSelector.setMRMLScene(slicer.mrmlScene)
+        self.roiSelector.setToolTip('The inputs are cropped to this region before the registration')
+        self.inputsLayout.addRow("Region of interest: ", self.roiSelector)
+
+        self.roiMarginSpinBox = qt.QDoubleSpinBox()
+        self.roiMarginSpinBox.minimum = 0
+        self.roiMarginSpinBox.maximum = 1000
+        self.roiMarginSpinBox.value = ROI_DEFAULT_MARGIN_MM
+        self.roiMarginSpinBox.suffix = ' mm'
+        self.roiMarginSpinBox.setAlignment(qt.Qt.AlignCenter)
+        self.inputsLayout.addRow("ROI margin: ", self.roiMarginSpinBox)
+
 
     def makeOutputsButton(self):
         self.outputsCollapsibleButton = ctk.ctkCollapsibleButton()
@@ -193,6 +379,73 @@ class BlockmatchingWidget(ScriptedLoadableModuleWidget):
         self.outputsLayout.addRow("Result volume: ", self.resultVolumeSelector)
 
 
+    def makeBatchButton(self):
+        self.batchCollapsibleButton = ctk.ctkCollapsibleButton()
+        self.batchCollapsibleButton.text = 'Batch'
+        self.batchCollapsibleButton.collapsed = True
+        self.layout.addWidget(self.batchCollapsibleButton)
+
+        self.batchLayout = qt.QFormLayout(self.batchCollapsibleButton)
+
+        self.batchFloatingSelector = slicer.qMRMLCheckableNodeComboBox()
+        self.batchFloatingSelector.nodeTypes = ["vtkMRMLScalarVolumeNode"]
+        self.batchFloatingSelector.addEnabled = False
+        self.batchFloatingSelector.removeEnabled = False
+        self.batchFloatingSelector.showHidden = False
+        self.batchFloatingSelector.showChildNodeTypes = False
+        self.batchFloatingSelector.setMRMLScene(slicer.mrmlScene)
+        self.batchFloatingSelector.setToolTip(
+            'Volumes registered to the reference with the current parameters.'
+            ' The floating thresholds are not used, as they are set for the selected floating volume.')
+        self.batchLayout.addRow("Floating volumes: ", self.batchFloatingSelector)
+
+        self.batchProcessesSpinBox = qt.QSpinBox()
+        self.batchProcessesSpinBox.minimum = 1
+        self.batchProcessesSpinBox.maximum = self.logic.getNumberOfCores()
+        self.batchProcessesSpinBox.value = self.logic.getBatchPoolSize(self.logic.getNumberOfCores())
+        self.batchProcessesSpinBox.setAlignment(qt.Qt.AlignCenter)
+        self.batchLayout.addRow("Concurrent processes: ", self.batchProcessesSpinBox)
+
+        self.batchButton = qt.QPushButton('Run batch')
+        self.batchButton.clicked.connect(self.onBatch)
+        self.batchLayout.addRow(self.batchButton)
+
+        self.batchStatusLabel = qt.QLabel()
+        self.batchLayout.addRow(self.batchStatusLabel)
+
+
+    def makePropagateButton(self):
+        self.propagateCollapsibleButton = ctk.ctkCollapsibleButton()
+        self.propagateCollapsibleButton.text = 'Propagate transform'
+        self.propagateCollapsibleButton.collapsed = True
+        self.layout.addWidget(self.propagateCollapsibleButton)
+
+        self.propagateLayout = qt.QFormLayout(self.propagateCollapsibleButton)
+
+        self.propagateVolumesSelector = slicer.qMRMLCheckableNodeComboBox()
+        self.propagateVolumesSelector.nodeTypes = ["vtkMRMLScalarVolumeNode", "vtkMRMLLabelMapVolumeNode"]
+        self.propagateVolumesSelector.addEnabled = False
+        self.propagateVolumesSelector.removeEnabled = False
+        self.propagateVolumesSelector.showHidden = False
+        self.propagateVolumesSelector.showChildNodeTypes = False  # no vector or DWI volumes
+        self.propagateVolumesSelector.setMRMLScene(slicer.mrmlScene)
+        self.propagateVolumesSelector.setToolTip(
+            'Volumes aligned with the floating volume.'
+            ' They are resampled on the grid of the reference volume.')
+        self.propagateLayout.addRow("Volumes: ", self.propagateVolumesSelector)
+
+        self.propagateHardenCheckBox = qt.QCheckBox()
+        self.propagateHardenCheckBox.setToolTip(
+            'Overwrite the volumes instead of adding resampled copies')
+        self.propagateLayout.addRow("Harden: ", self.propagateHardenCheckBox)
+
+        self.propagateButton = qt.QPushButton('Propagate result transform')
+        self.propagateButton.clicked.connect(self.onPropagate)
+        self.propagateLayout.addRow(self.propagateButton)
+
+        self.batch = None
+
+
     def makeParametersButton(self):
         self.parametersCollapsibleButton = ctk.ctkCollapsibleButton()
         self.parametersCollapsibleButton.text = 'Parameters'
@@ -204,7 +457,9 @@ class BlockmatchingWidget(ScriptedLoadableModuleWidget):
 
         self.makeTransformationTypeWidgets()
         self.makePyramidWidgets()
+        self.makeBlockMatchingWidgets()
         self.makeThresholdsWidgets()
+        self.makePerformanceWidgets()
 
 
     def makeTransformationTypeWidgets(self):
@@ -221,6 +476,12 @@ class BlockmatchingWidget(ScriptedLoadableModuleWidget):
 
         self.trsfTypeRadioButtons[0].setChecked(True)
 
+        self.cascadeCheckBox = qt.QCheckBox('Cascade (initialize with simpler transformations)')
+        self.cascadeCheckBox.toolTip = ('Run rigid, then affine, then vectorfield up to the selected type. '
+                                        'Each stage is initialized with the previous result and starts '
+                                        'one pyramid level lower.')
+        trsfTypeLayout.addWidget(self.cascadeCheckBox)
+
 
     def makePyramidWidgets(self):
         self.pyramidTab = qt.QWidget()
@@ -248,9 +509,79 @@ class BlockmatchingWidget(ScriptedLoadableModuleWidget):
         self.pyramidLayout.addWidget(self.pyramidLowestLabel, 1, 2)
 
         self.pyramidGaussianFilteringCheckBox = qt.QCheckBox()
+        self.pyramidGaussianFilteringCheckBox.toggled.connect(self.schedulePreview)
         self.pyramidLayout.addWidget(qt.QLabel('Gaussian filtering:'), 2, 0)
         self.pyramidLayout.addWidget(self.pyramidGaussianFilteringCheckBox, 2, 1)
 
+        self.pyramidTimeBudgetSpinBox = qt.QDoubleSpinBox()
+        self.pyramidTimeBudgetSpinBox.minimum = 1
+        self.pyramidTimeBudgetSpinBox.maximum = 24 * 3600
+        self.pyramidTimeBudgetSpinBox.value = DEFAULT_TIME_BUDGET_SECONDS
+        self.pyramidTimeBudgetSpinBox.suffix = ' s'
+        self.pyramidTimeBudgetSpinBox.setAlignment(qt.Qt.AlignCenter)
+        self.pyramidPlanButton = qt.QPushButton('Choose levels')
+        self.pyramidPlanButton.setToolTip('Choose the finest levels that fit in the time budget')
+        self.pyramidPlanButton.clicked.connect(self.onPlanPyramidLevels)
+        self.pyramidLayout.addWidget(qt.QLabel('Time budget:'), 3, 0)
+        self.pyramidLayout.addWidget(self.pyramidTimeBudgetSpinBox, 3, 1)
+        self.pyramidLayout.addWidget(self.pyramidPlanButton, 3, 2)
+
+        self.pyramidTimeLabel = qt.QLabel()
+        self.pyramidTimeLabel.setAlignment(qt.Qt.AlignCenter)
+        self.pyramidLayout.addWidget(self.pyramidTimeLabel, 4, 0, 1, 3)
+
+        self.referencePyramidMap = None
+
+
+    def makeBlockMatchingWidgets(self):
+        self.blockMatchingTab = qt.QWidget()
+        self.parametersTabWidget.addTab(self.blockMatchingTab, 'Block matching')
+        self.blockMatchingLayout = qt.QFormLayout(self.blockMatchingTab)
+
+        def makeTriplet(values, minimum):
+            frame = qt.QFrame()
+            layout = qt.QHBoxLayout(frame)
+            layout.setContentsMargins(0, 0, 0, 0)
+            spinBoxes = []
+            for value in values:
+                spinBox = qt.QSpinBox()
+                spinBox.minimum = minimum
+                spinBox.maximum = 64
+                spinBox.value = value
+                spinBox.setAlignment(qt.Qt.AlignCenter)
+                spinBox.valueChanged.connect(self.onPyramidLevelsChanged)
+                layout.addWidget(spinBox)
+                spinBoxes.append(spinBox)
+            return frame, spinBoxes
+
+        frame, self.blockSizeSpinBoxes = makeTriplet(BLOCK_SIZE, 1)
+        self.blockMatchingLayout.addRow('Block size: ', frame)
+        frame, self.blockSpacingSpinBoxes = makeTriplet(BLOCK_SPACING, 1)
+        self.blockMatchingLayout.addRow('Block spacing: ', frame)
+        frame, self.blockBorderSpinBoxes = makeTriplet(BLOCK_BORDER, 0)
+        self.blockMatchingLayout.addRow('Block border: ', frame)
+        frame, self.searchHalfSizeSpinBoxes = makeTriplet(SEARCH_NEIGHBORHOOD_HALF_SIZE, 0)
+        self.blockMatchingLayout.addRow('Search half size: ', frame)
+        frame, self.searchStepSpinBoxes = makeTriplet(SEARCH_NEIGHBORHOOD_STEP, 1)
+        self.blockMatchingLayout.addRow('Search step: ', frame)
+
+        self.floatingSelectionFractionSpinBox = qt.QDoubleSpinBox()
+        self.floatingSelectionFractionSpinBox.minimum = 0.01
+        self.floatingSelectionFractionSpinBox.maximum = 1
+        self.floatingSelectionFractionSpinBox.singleStep = 0.05
+        self.floatingSelectionFractionSpinBox.value = FLOATING_SELECTION_FRACTION
+        self.floatingSelectionFractionSpinBox.setAlignment(qt.Qt.AlignCenter)
+        self.floatingSelectionFractionSpinBox.valueChanged.connect(self.onPyramidLevelsChanged)
+        self.blockMatchingLayout.addRow('Floating selection fraction: ', self.floatingSelectionFractionSpinBox)
+
+        self.blockEstimatesTable = qt.QTableWidget()
+        self.blockEstimatesTable.setColumnCount(4)
+        self.blockEstimatesTable.setHorizontalHeaderLabels(['Level', 'Shape', 'Blocks', 'Evaluations'])
+        self.blockEstimatesTable.horizontalHeader().setSectionResizeMode(qt.QHeaderView.Stretch)
+        self.blockEstimatesTable.verticalHeader().hide()
+        self.blockEstimatesTable.setEditTriggers(qt.QAbstractItemView.NoEditTriggers)
+        self.blockMatchingLayout.addRow(self.blockEstimatesTable)
+
 
     def makeThresholdsWidgets(self):
         self.thresholdsTab = qt.QWidget()
@@ -267,6 +598,123 @@ class BlockmatchingWidget(ScriptedLoadableModuleWidget):
         self.floatingThresholdSlider.valuesChanged.connect(self.onFloatingThresholdSlider)
         self.thresholdsLayout.addRow('Floating: ', self.floatingThresholdSlider)
 
+        self.percentilesCheckBox = qt.QCheckBox()
+        self.percentilesCheckBox.toggled.connect(self.onPercentilesToggled)
+        self.thresholdsLayout.addRow('Use percentiles: ', self.percentilesCheckBox)
+
+        self.referencePercentileSlider = ctk.ctkRangeWidget()
+        self.referencePercentileSlider.decimals = 1
+        self.referencePercentileSlider.singleStep = 0.1
+        self.referencePercentileSlider.minimum = 0
+        self.referencePercentileSlider.maximum = 100
+        self.referencePercentileSlider.minimumValue = 0
+        self.referencePercentileSlider.maximumValue = 100
+        self.referencePercentileSlider.valuesChanged.connect(self.onReferencePercentileSlider)
+        self.thresholdsLayout.addRow('Reference percentiles: ', self.referencePercentileSlider)
+
+        self.floatingPercentileSlider = ctk.ctkRangeWidget()
+        self.floatingPercentileSlider.decimals = 1
+        self.floatingPercentileSlider.singleStep = 0.1
+        self.floatingPercentileSlider.minimum = 0
+        self.floatingPercentileSlider.maximum = 100
+        self.floatingPercentileSlider.minimumValue = 0
+        self.floatingPercentileSlider.maximumValue = 100
+        self.floatingPercentileSlider.valuesChanged.connect(self.onFloatingPercentileSlider)
+        self.thresholdsLayout.addRow('Floating percentiles: ', self.floatingPercentileSlider)
+
+        self.referenceRemovedFractionSpinBox = qt.QDoubleSpinBox()
+        self.referenceRemovedFractionSpinBox.minimum = 0
+        self.referenceRemovedFractionSpinBox.maximum = 1
+        self.referenceRemovedFractionSpinBox.singleStep = 0.05
+        self.referenceRemovedFractionSpinBox.value = 0.5
+        self.referenceRemovedFractionSpinBox.setAlignment(qt.Qt.AlignCenter)
+        self.thresholdsLayout.addRow('Reference removed fraction: ', self.referenceRemovedFractionSpinBox)
+
+        self.floatingRemovedFractionSpinBox = qt.QDoubleSpinBox()
+        self.floatingRemovedFractionSpinBox.minimum = 0
+        self.floatingRemovedFractionSpinBox.maximum = 1
+        self.floatingRemovedFractionSpinBox.singleStep = 0.05
+        self.floatingRemovedFractionSpinBox.value = 0.5
+        self.floatingRemovedFractionSpinBox.setAlignment(qt.Qt.AlignCenter)
+        self.thresholdsLayout.addRow('Floating removed fraction: ', self.floatingRemovedFractionSpinBox)
+
+        self.useThresholdsCheckBox = qt.QCheckBox()
+        self.useThresholdsCheckBox.toggled.connect(self.schedulePreview)
+        self.thresholdsLayout.addRow('Pass thresholds to blockmatching: ', self.useThresholdsCheckBox)
+        self.referenceRemovedFractionSpinBox.valueChanged.connect(self.schedulePreview)
+        self.floatingRemovedFractionSpinBox.valueChanged.connect(self.schedulePreview)
+
+        self.onPercentilesToggled()
+
+
+    def makePerformanceWidgets(self):
+        self.performanceTab = qt.QWidget()
+        self.parametersTabWidget.addTab(self.performanceTab, 'Performance')
+        self.performanceLayout = qt.QFormLayout(self.performanceTab)
+
+        self.performanceModeComboBox = qt.QComboBox()
+        self.performanceModeComboBox.addItems(PERFORMANCE_MODES)
+        self.performanceModeComboBox.currentIndexChanged.connect(self.onPerformanceModeChanged)
+        self.performanceLayout.addRow('Mode: ', self.performanceModeComboBox)
+
+        self.parallelCheckBox = qt.QCheckBox()
+        self.parallelCheckBox.setChecked(True)
+        self.performanceLayout.addRow('Parallel: ', self.parallelCheckBox)
+
+        self.maxChunksSpinBox = qt.QSpinBox()
+        self.maxChunksSpinBox.minimum = 1
+        self.maxChunksSpinBox.maximum = 1024
+        self.maxChunksSpinBox.value = self.logic.getNumberOfCores()
+        self.maxChunksSpinBox.setAlignment(qt.Qt.AlignCenter)
+        self.performanceLayout.addRow('Max. chunks: ', self.maxChunksSpinBox)
+
+        self.parallelismTypeComboBox = qt.QComboBox()
+        self.parallelismTypeComboBox.addItems(PARALLELISM_TYPES)
+        self.performanceLayout.addRow('Parallelism type: ', self.parallelismTypeComboBox)
+
+        self.ompSchedulingComboBox = qt.QComboBox()
+        self.ompSchedulingComboBox.addItems(OMP_SCHEDULINGS)
+        self.performanceLayout.addRow('OpenMP scheduling: ', self.ompSchedulingComboBox)
+
+        self.calibrateButton = qt.QPushButton('Calibrate')
+        self.calibrateButton.clicked.connect(lambda: self.onCalibrate())
+        self.calibrationLabel = qt.QLabel()
+        self.performanceLayout.addRow(self.calibrateButton, self.calibrationLabel)
+
+        self.resultCacheSpinBox = qt.QSpinBox()
+        self.resultCacheSpinBox.minimum = 0
+        self.resultCacheSpinBox.maximum = 1000
+        self.resultCacheSpinBox.suffix = ' GB'
+        self.resultCacheSpinBox.specialValueText = 'Disabled'
+        self.resultCacheSpinBox.value = self.logic.getResultCacheMaxGB()
+        self.resultCacheSpinBox.setAlignment(qt.Qt.AlignCenter)
+        self.resultCacheSpinBox.valueChanged.connect(self.logic.setResultCacheMaxGB)
+        self.performanceLayout.addRow('Results cache: ', self.resultCacheSpinBox)
+
+        self.compactInputsCheckBox = qt.QCheckBox()
+        self.compactInputsCheckBox.setChecked(self.logic.getCompactInputs())
+        self.compactInputsCheckBox.setToolTip('Write the inputs with the smallest integer type that holds their values')
+        self.compactInputsCheckBox.toggled.connect(self.logic.setCompactInputs)
+        self.performanceLayout.addRow('Compact inputs: ', self.compactInputsCheckBox)
+
+        self.compressionLevelSpinBox = qt.QSpinBox()
+        self.compressionLevelSpinBox.minimum = 0
+        self.compressionLevelSpinBox.maximum = 9
+        self.compressionLevelSpinBox.specialValueText = 'None'
+        self.compressionLevelSpinBox.value = self.logic.getCompressionLevel()
+        self.compressionLevelSpinBox.setAlignment(qt.Qt.AlignCenter)
+        self.compressionLevelSpinBox.setToolTip('Gzip the results and the cached results')
+        self.compressionLevelSpinBox.valueChanged.connect(self.logic.setCompressionLevel)
+        self.performanceLayout.addRow('Results compression: ', self.compressionLevelSpinBox)
+
+        self.cleanupCheckBox = qt.QCheckBox()
+        self.cleanupCheckBox.setChecked(self.logic.getCleanupIntermediates())
+        self.cleanupCheckBox.setToolTip('Remove the temporary files of a run once its results are loaded')
+        self.cleanupCheckBox.toggled.connect(self.logic.setCleanupIntermediates)
+        self.performanceLayout.addRow('Remove temporary files: ', self.cleanupCheckBox)
+
+        self.onPerformanceModeChanged()
+
 
     def getSelectedTransformationType(self):
         for b in self.trsfTypeRadioButtons:
@@ -275,190 +723,144 @@ class BlockmatchingWidget(ScriptedLoadableModuleWidget):
         return trsfType
 
 
-    def getCommandLineList(self):
-        self.tempDir = str(slicer.util.tempDirectory())
-
-        self.refPath = self.logic.getNodeFilepath(self.referenceVolumeNode)
-        self.floPath = self.logic.getNodeFilepath(self.floatingVolumeNode)
-
-        refName = self.referenceVolumeNode.GetName()
-        floName = self.floatingVolumeNode.GetName()
-
-        dateTime = datetime.datetime.now()
-
-        # We make sure they are in the disk
-        if not self.refPath or not self.logic.hasNiftiExtension(self.refPath):
-            self.refPath = self.logic.getTempPath(self.tempDir,
-                                                  '.nii',
-                                                  filename=refName,
-                                                  dateTime=dateTime)
-            slicer.util.saveNode(self.referenceVolumeNode, self.refPath)
-
-        if not self.floPath or not self.logic.hasNiftiExtension(self.floPath):
-            self.floPath = self.logic.getTempPath(self.tempDir,
-                                                  '.nii',
-                                                  filename=floName,
-                                                  dateTime=dateTime)
-            slicer.util.saveNode(self.floatingVolumeNode, self.floPath)
-
-
-        self.resPath = self.logic.getTempPath(self.tempDir,
-                                              '.nii',
-                                              filename='{}_on_{}'.format(floName, refName),
-                                              dateTime=dateTime)
-
-        trsfExtension = '.trsf' if self.transformationTypeIsLinear() else '.nii'
-
-        self.resultTransformPath = self.logic.getTempPath(self.tempDir,
-                                                          trsfExtension,
-                                                          filename='t_ref-{}_flo-{}'.format(refName, floName),
-                                                          dateTime=dateTime)
-
-        trsfType = self.getSelectedTransformationType()
-
-        # Save the command line for debugging
-        self.cmdPath = self.logic.getTempPath(self.tempDir,
-                                              '.txt',
-                                              filename='cmd_ref-{}_flo-{}_{}'.format(refName, floName, trsfType),
-                                              dateTime=dateTime)
-        self.logPath = self.logic.getTempPath(self.tempDir,
-                                              '.txt',
-                                              filename='log_ref-{}_flo-{}_{}'.format(refName, floName, trsfType),
-                                              dateTime=dateTime)
-
-        refThreshMin, refThreshMax = self.referenceNormalizedThresholds
-        floThreshMin, floThreshMax = self.floatingNormalizedThresholds
-
-        self.displacementFieldPath = self.logic.getTempPath(
-            self.tempDir, '.nii',
-            filename='disp_field_ref-{}_flo-{}_{}'.format(refName, floName, trsfType),
-            dateTime=dateTime)
-
-        cmd = [BLOCKMATCHING_PATH]
-        cmd += ['-reference', self.refPath]
-        cmd += ['-floating', self.floPath]
-        cmd += ['-result', self.resPath]
-        cmd += ['-result-transformation', self.resultTransformPath]
-        # cmd += ['-reference-low-threshold', str(refThreshMin)]
-        # cmd += ['-reference-high-threshold', str(refThreshMax)]
-        # cmd += ['-floating-low-threshold', str(floThreshMin)]
-        # cmd += ['-floating-high-threshold', str(floThreshMax)]
-        cmd += ['-pyramid-highest-level', str(self.pyramidHighestSpinBox.value)]
-        cmd += ['-pyramid-lowest-level', str(self.pyramidLowestSpinBox.value)]
-        cmd += ['-transformation-type', trsfType]
-        cmd += ['-command-line', self.cmdPath]
-        cmd += ['-logfile', self.logPath]
-
-
-        if self.pyramidGaussianFilteringCheckBox.isChecked():
-            cmd += ['-pyramid-gaussian-filtering']
-
-        if self.initialTransformNode:
-            self.initialTransformPath = str(self.logic.getTempPath(self.tempDir, '.trsf', dateTime=dateTime))
-            self.logic.writeBaladinMatrix(self.initialTransformNode, self.initialTransformPath)
-            cmd += ['-initial-transformation', self.initialTransformPath]
-            cmd += ['-composition-with-initial']
-
-        self.commandLineList = cmd
-
-
-    def printCommandLine(self):
+    def getBlockMatchingOptions(self):
         """
-        Pretty-prints the command line so that it can be copied from the Python
-        console and pasted on a terminal.
+        Only the values that differ from the blockmatching defaults are
+        passed, so that the command line stays short
         """
-        prettyCmd = []
-        for s in self.commandLineList:
-            if s.startswith('-'):
-                prettyCmd.append('\\\n')
-            prettyCmd.append(s)
-        print(' '.join(prettyCmd))
+        options = {}
+        for key, spinBoxes, default in (
+                ('blockSize', self.blockSizeSpinBoxes, BLOCK_SIZE),
+                ('blockSpacing', self.blockSpacingSpinBoxes, BLOCK_SPACING),
+                ('blockBorder', self.blockBorderSpinBoxes, BLOCK_BORDER),
+                ('searchHalfSize', self.searchHalfSizeSpinBoxes, SEARCH_NEIGHBORHOOD_HALF_SIZE),
+                ('searchStep', self.searchStepSpinBoxes, SEARCH_NEIGHBORHOOD_STEP)):
+            values = [spinBox.value for spinBox in spinBoxes]
+            if values != default:
+                options[key] = values
+        fraction = self.floatingSelectionFractionSpinBox.value
+        if fraction != FLOATING_SELECTION_FRACTION:
+            options['floatingSelectionFraction'] = fraction
+        return options
+
+
+    def getParameters(self):
+        parameters = BlockmatchingParameters(
+            trsfType=self.getSelectedTransformationType(),
+            pyramidHighestLevel=self.pyramidHighestSpinBox.value,
+            pyramidLowestLevel=self.pyramidLowestSpinBox.value,
+            gaussianFiltering=self.pyramidGaussianFilteringCheckBox.isChecked(),
+            parallelism=self.getParallelism(),
+            **self.getBlockMatchingOptions())
+        if self.useThresholdsCheckBox.isChecked():
+            parameters.referenceThresholds = self.logic.getNormalizedThresholds(self.referenceVolumeNode)
+            parameters.floatingThresholds = self.logic.getNormalizedThresholds(self.floatingVolumeNode)
+            parameters.referenceRemovedFraction = self.referenceRemovedFractionSpinBox.value
+            parameters.floatingRemovedFraction = self.floatingRemovedFractionSpinBox.value
+        return parameters
+
+
+    def getParallelism(self):
+        mode = self.performanceModeComboBox.currentText
+        if mode == 'Default':
+            return None
+        elif mode == 'Auto':
+            return self.logic.getCachedParallelism()
+        else:
+            return dict(parallel=self.parallelCheckBox.isChecked(),
+                        maxChunks=self.maxChunksSpinBox.value,
+                        parallelismType=self.parallelismTypeComboBox.currentText,
+                        ompScheduling=self.ompSchedulingComboBox.currentText)
 
 
-    def repareResults(self):
+    def loadResults(self, engine):
         """
-        This is used to convert output .hdr Analyze into NIfTI
+        The results are loaded into the nodes selected when the run started.
+        The result nodes are updated in place, so the views showing them are
+        only refitted if their geometry has changed
         """
+        tIni = time.time()
+        geometryChanged = False
 
-        if self.resPath.endswith('.hdr'):
-            print('Correcting result .hdr image')
-            shutil.copy(self.refPath, self.resPath)
-
-
-    def loadResults(self):
         # Remove transform from reference
-        self.referenceVolumeNode.SetAndObserveTransformNodeID(None)
-
-        # Load the result node
-        if self.resultVolumeNode is not None:
-            # Remove result node
-            resultName = self.resultVolumeNode.GetName()
-            slicer.mrmlScene.RemoveNode(self.resultVolumeNode)
-
-            # Load the new one
-            # When loading a 2D image with slicer.util, there is a bug that
-            # keeps stacking the output result instead of creating a 2D image
-            if self.logic.is2D(self.referenceVolumeNode):  # load using SimpleITK
-                resultImage = sitk.ReadImage(self.resPath)
-                su.PushToSlicer(resultImage, resultName, overwrite=True)
-                self.resultVolumeNode = slicer.util.getNode(resultName)
-            else:  # load using slicer.util.loadVolume()
-                self.resultVolumeNode = slicer.util.loadVolume(self.resPath)
-            self.resultVolumeNode.SetName(resultName)
-            self.resultVolumeSelector.setCurrentNode(self.resultVolumeNode)
-            fgVolume = self.resultVolumeNode
+        engine.reference.SetAndObserveTransformNodeID(None)
+
+        # Copy the result image in the result node
+        if engine.resultVolumeNode is not None:
+            geometryChanged = self.logic.updateVolumeFromFile(engine.resultVolumeNode, engine.resultPath)
+            fgVolume = engine.resultVolumeNode
 
         # If a transform was given, copy the result in it and apply it to the floating image
-        if self.resultTransformNode is not None:
-            if self.transformationTypeIsLinear():
-                matrix = self.logic.readBaladinMatrix(self.resultTransformPath)
-                vtkMatrix = self.logic.getVTKMatrixFromNumpyMatrix(matrix)
-                self.resultTransformNode.SetMatrixTransformFromParent(vtkMatrix)
-            else:
-                # Remove result transform node from scene
-                resultTransformName = self.resultTransformNode.GetName()
-                slicer.mrmlScene.RemoveNode(self.resultTransformNode)
-
-                # Load the generated transform node
-                self.resultTransformNode = self.logic.loadRASDisplacementFieldTransform(self.resultTransformPath)
-                self.resultTransformNode.SetName(resultTransformName)
-                self.resultTransformSelector.setCurrentNode(self.resultTransformNode)
-
-                # For debugging
-                if self.developerMode:
-                    self.resultDisplacementFieldVolumeNode = slicer.util.loadVolume(self.displacementFieldPath)
-                    if self.resultDisplacementFieldVolumeNode:
-                        self.resultDisplacementFieldVolumeNode.SetName(resultTransformName)
-                    else:
-                        print(self.displacementFieldPath, 'not loaded!')
+        if engine.resultTransformNode is not None:
+            previousNode = engine.resultTransformNode
+            engine.resultTransformNode = engine.loadResultTransform(name=previousNode.GetName(),
+                                                                    transformNode=previousNode)
+            if engine.resultTransformNode is not previousNode:
+                # e.g. a displacement field cannot be stored in a linear transform node
+                if self.resultTransformSelector.currentNode() is previousNode:
+                    self.resultTransformSelector.setCurrentNode(engine.resultTransformNode)
+                slicer.mrmlScene.RemoveNode(previousNode)
+
+            # For debugging
+            if self.developerMode and not engine.parameters.isLinear():
+                resultTransformName = engine.resultTransformNode.GetName()
+                self.resultDisplacementFieldVolumeNode = slicer.util.loadVolume(engine.displacementFieldPath)
+                if self.resultDisplacementFieldVolumeNode:
+                    self.resultDisplacementFieldVolumeNode.SetName(resultTransformName)
+                else:
+                    print(engine.displacementFieldPath, 'not loaded!')
 
             # Apply transform to floating if no result volume node was selected
-            if self.resultVolumeNode is None:
-                self.floatingVolumeNode.SetAndObserveTransformNodeID(self.resultTransformNode.GetID())
-                fgVolume = self.floatingVolumeNode
-
-        self.logic.setSlicesBackAndForeground(bgVolume=self.referenceVolumeNode,
-                                              fgVolume=fgVolume,
-                                              opacity=0.5,
-                                              colors=True)
+            if engine.resultVolumeNode is None:
+                engine.floating.SetAndObserveTransformNodeID(engine.resultTransformNode.GetID())
+                fgVolume = engine.floating
 
-        self.logic.centerViews()
+        if engine.record is not None:
+            engine.record['phases']['loading'] = time.time() - tIni
+        # The run is recorded once the views are updated
+        engine.historyDeferred = not engine.historyWritten
+        self.scheduleViewUpdate(engine.reference, fgVolume, fit=geometryChanged, engine=engine)
 
 
-    def outputsExist(self):
+    def scheduleViewUpdate(self, bgVolume, fgVolume, fit=False, engine=None):
         """
-        We need this because it's not clear that blockmatching returns non-zero
-        when failed
+        Coalesces the updates of the slice views, e.g. if several
+        registrations finish during the same event loop iteration.
+        The update is timed as the scene phase of engine.
         """
-        if self.resultVolumeNode is not None:
-            if not os.path.isfile(self.resPath):
-                return False
+        engines = []
+        if self.pendingViewUpdate is not None:
+            fit = fit or self.pendingViewUpdate[2]
+            engines = self.pendingViewUpdate[3]
+        if engine is not None:
+            engines.append(engine)
+        self.pendingViewUpdate = bgVolume, fgVolume, fit, engines
+        self.viewUpdateTimer.start()
+
+
+    def updateViews(self):
+        if self.pendingViewUpdate is None: return
+        bgVolume, fgVolume, fit, engines = self.pendingViewUpdate
+        self.pendingViewUpdate = None
+        tIni = time.time()
 
-        if self.resultTransformNode is not None:
-            if not os.path.isfile(self.resultTransformPath):
-                return False
+        # Views showing other volumes are fitted to the new ones
+        compositeNode = slicer.app.layoutManager().sliceWidget('Red').sliceLogic().GetSliceCompositeNode()
+        fit = fit or compositeNode.GetBackgroundVolumeID() != bgVolume.GetID()
+        fit = fit or compositeNode.GetForegroundVolumeID() != fgVolume.GetID()
+
+        self.logic.setSlicesBackAndForeground(bgVolume=bgVolume,
+                                              fgVolume=fgVolume,
+                                              opacity=0.5,
+                                              colors=True)
+        if fit:
+            self.logic.centerViews()
 
-        return True
+        sceneTime = time.time() - tIni
+        for engine in engines:
+            if engine.record is not None:
+                engine.record['phases']['scene'] = sceneTime
+            engine.writeHistory()
 
 
     def validateMatrices(self):
@@ -514,9 +916,6 @@ class BlockmatchingWidget(ScriptedLoadableModuleWidget):
         self.resultVolumeNode = self.resultVolumeSelector.currentNode()
         self.resultTransformNode = self.resultTransformSelector.currentNode()
 
-        self.referenceNormalizedThresholds = self.logic.getNormalizedThresholds(self.referenceVolumeNode)
-        self.floatingNormalizedThresholds = self.logic.getNormalizedThresholds(self.floatingVolumeNode)
-
 
     def transformationTypeIsLinear(self):
         return self.getSelectedTransformationType() != 'vectorfield'
@@ -530,7 +929,7 @@ class BlockmatchingWidget(ScriptedLoadableModuleWidget):
         validMinimumInputs = self.referenceVolumeNode and \
                              self.floatingVolumeNode and \
                              (self.resultVolumeNode or self.resultTransformNode)
-        self.applyButton.setEnabled(validMinimumInputs)
+        self.applyButton.setEnabled(bool(validMinimumInputs) and not self.isProcessRunning())
 
         # Update pyramid widgets
         self.referencePyramidMap = self.logic.getPyramidShapesMap(self.referenceVolumeNode)
@@ -566,11 +965,16 @@ class BlockmatchingWidget(ScriptedLoadableModuleWidget):
             self.floatingThresholdSlider.maximumValue = thresholdMax
             self.floatingThresholdSlider.setEnabled(True)
 
+        if self.percentilesCheckBox.isChecked():
+            self.onReferencePercentileSlider()
+            self.onFloatingPercentileSlider()
+
 
     def onTransformationTypeChanged(self):
         trsf = self.getSelectedTransformationType()
         self.resultTransformSelector.baseName = 'Output %s transform' % trsf
         self.resultVolumeSelector.baseName = 'Output %s volume' % trsf
+        self.onPyramidLevelsChanged()  # predictions depend on the type
 
 
     def onPyramidLevelsChanged(self):
@@ -584,11 +988,139 @@ class BlockmatchingWidget(ScriptedLoadableModuleWidget):
         if self.referencePyramidMap is None:
             self.pyramidHighestLabel.text = ''
             self.pyramidLowestLabel.text = ''
+            self.pyramidTimeLabel.text = ''
+        else:
+            highestLevel = self.pyramidHighestSpinBox.value
+            lowestLevel = self.pyramidLowestSpinBox.value
+            highestLevelShape = self.referencePyramidMap[highestLevel]
+            lowestLevelShape = self.referencePyramidMap[lowestLevel]
+            parameters = self.getEstimateParameters()
+            trsfType = parameters.trsfType
+            times = self.logic.predictLevelTimes(self.referencePyramidMap[0], parameters)
+            self.pyramidHighestLabel.text = '{} (~{:.1f} s)'.format(
+                getShapeString(highestLevelShape), times[highestLevel])
+            self.pyramidLowestLabel.text = '{} (~{:.1f} s)'.format(
+                getShapeString(lowestLevelShape), times[lowestLevel])
+            numberOfRuns = self.logic.getSecondsPerCost(trsfType)[1]
+            if numberOfRuns:
+                source = 'from {} previous runs'.format(numberOfRuns)
+            else:
+                source = 'not calibrated yet'
+            self.pyramidTimeLabel.text = 'Predicted time: ~{:.1f} s ({})'.format(sum(times.values()), source)
+        self.updateBlockEstimates()
+        self.schedulePreview()
+
+
+    def getEstimateParameters(self):
+        """
+        The parameters that change the cost of the registration
+        """
+        return BlockmatchingParameters(trsfType=self.getSelectedTransformationType(),
+                                       pyramidHighestLevel=self.pyramidHighestSpinBox.value,
+                                       pyramidLowestLevel=self.pyramidLowestSpinBox.value,
+                                       **self.getBlockMatchingOptions())
+
+
+    def updateBlockEstimates(self):
+        table = self.blockEstimatesTable
+        if self.referencePyramidMap is None:
+            table.setRowCount(0)
+            return
+
+        parameters = self.getEstimateParameters()
+        blockParameters = parameters.getBlockParameters()
+        levels = range(parameters.pyramidHighestLevel, parameters.pyramidLowestLevel - 1, -1)
+        table.setRowCount(len(levels))
+        for row, level in enumerate(levels):
+            shape = self.referencePyramidMap[level]
+            numberOfBlocks, selectedBlocks, evaluations, _ = self.logic.getBlockCounts(shape, **blockParameters)
+            texts = (str(level),
+                     ' x '.join(str(n) for n in shape),
+                     '{} ({} matched)'.format(numberOfBlocks, selectedBlocks),
+                     '{:.3g}'.format(evaluations))
+            for column, text in enumerate(texts):
+                table.setItem(row, column, qt.QTableWidgetItem(text))
+
+
+    def onPlanPyramidLevels(self):
+        if self.referencePyramidMap is None: return
+        highestLevel, lowestLevel = self.logic.planPyramidLevels(
+            self.referencePyramidMap[0],
+            self.pyramidTimeBudgetSpinBox.value,
+            self.getEstimateParameters())
+        # Lower the lowest level first so that the spin boxes limits allow the values
+        self.pyramidLowestSpinBox.value = 0
+        self.pyramidHighestSpinBox.value = highestLevel
+        self.pyramidLowestSpinBox.value = lowestLevel
+
+
+    def onPerformanceModeChanged(self):
+        manual = self.performanceModeComboBox.currentText == 'Manual'
+        for widget in (self.parallelCheckBox,
+                       self.maxChunksSpinBox,
+                       self.parallelismTypeComboBox,
+                       self.ompSchedulingComboBox):
+            widget.setEnabled(manual)
+        self.updateCalibrationLabel()
+
+
+    def updateCalibrationLabel(self):
+        parallelism = self.logic.getCachedParallelism()
+        if parallelism is None:
+            self.calibrationLabel.text = 'Not calibrated'
         else:
-            highestLevelShape = self.referencePyramidMap[self.pyramidHighestSpinBox.value]
-            lowestLevelShape = self.referencePyramidMap[self.pyramidLowestSpinBox.value]
-            self.pyramidHighestLabel.text = getShapeString(highestLevelShape)
-            self.pyramidLowestLabel.text = getShapeString(lowestLevelShape)
+            self.calibrationLabel.text = '{} chunks, {} scheduling'.format(
+                parallelism['maxChunks'], parallelism['ompScheduling'])
+
+
+    def onCalibrate(self, onFinished=None):
+        self.readParameters()
+        if self.referenceVolumeNode is None or self.floatingVolumeNode is None:
+            slicer.util.errorDisplay('Reference and floating volumes must be selected')
+            return
+
+        def onCalibrationFinished(parallelism):
+            self.calibrateButton.setEnabled(True)
+            self.updateCalibrationLabel()
+            if parallelism is None:
+                slicer.util.errorDisplay('Calibration failed', windowTitle='Calibration error')
+            elif onFinished is not None:
+                onFinished()
+
+        self.calibrateButton.setEnabled(False)
+        self.calibrationLabel.text = 'Calibrating...'
+        self.logic.calibrateParallelism(self.referenceVolumeNode,
+                                        self.floatingVolumeNode,
+                                        trsfType=self.getSelectedTransformationType(),
+                                        pyramidLevel=self.pyramidHighestSpinBox.value,
+                                        onFinished=onCalibrationFinished)
+
+
+    def onPercentilesToggled(self):
+        usePercentiles = self.percentilesCheckBox.isChecked()
+        self.referencePercentileSlider.setEnabled(usePercentiles)
+        self.floatingPercentileSlider.setEnabled(usePercentiles)
+        if usePercentiles:
+            self.onReferencePercentileSlider()
+            self.onFloatingPercentileSlider()
+
+
+    def onReferencePercentileSlider(self):
+        if not self.percentilesCheckBox.isChecked(): return
+        if self.referenceSelector.currentNode() is None: return
+        thresholds = self.logic.getPercentileThresholds(self.referenceSelector.currentNode(),
+                                                        self.referencePercentileSlider.minimumValue,
+                                                        self.referencePercentileSlider.maximumValue)
+        self.referenceThresholdSlider.setValues(*thresholds)
+
+
+    def onFloatingPercentileSlider(self):
+        if not self.percentilesCheckBox.isChecked(): return
+        if self.floatingSelector.currentNode() is None: return
+        thresholds = self.logic.getPercentileThresholds(self.floatingSelector.currentNode(),
+                                                        self.floatingPercentileSlider.minimumValue,
+                                                        self.floatingPercentileSlider.maximumValue)
+        self.floatingThresholdSlider.setValues(*thresholds)
 
 
     def onReferenceThresholdSlider(self):
@@ -599,6 +1131,7 @@ class BlockmatchingWidget(ScriptedLoadableModuleWidget):
             thresMin = self.referenceThresholdSlider.minimumValue
             thresMax = self.referenceThresholdSlider.maximumValue
             displayNode.SetThreshold(thresMin, thresMax)
+        self.schedulePreview()
 
 
     def onFloatingThresholdSlider(self):
@@ -609,43 +1142,1367 @@ class BlockmatchingWidget(ScriptedLoadableModuleWidget):
             thresMin = self.floatingThresholdSlider.minimumValue
             thresMax = self.floatingThresholdSlider.maximumValue
             displayNode.SetThreshold(thresMin, thresMax)
+        self.schedulePreview()
 
 
     def onApply(self):
+        if self.isProcessRunning(): return
+        autoMode = self.performanceModeComboBox.currentText == 'Auto'
+        if autoMode and self.logic.getCachedParallelism() is None:
+            self.onCalibrate(onFinished=self.onApply)
+            return
+
         self.readParameters()
-        self.getCommandLineList()
-        if not self.validateParameters(): return
+        self.removePreview()
+        if self.cascadeCheckBox.isChecked():
+            if self.validateParameters():
+                self.startCascade()
+            return
+
+        self.engine = BlockmatchingEngine(self.logic,
+                                          self.referenceVolumeNode,
+                                          self.floatingVolumeNode,
+                                          parameters=self.getParameters(),
+                                          initialTransform=self.initialTransformNode)
+        self.engine.requireResultVolume = self.resultVolumeNode is not None
+        self.engine.resultVolumeNode = self.resultVolumeNode
+        self.engine.resultTransformNode = self.resultTransformNode
+        self.engine.roi = self.roiSelector.currentNode()
+        self.engine.roiMargin = self.roiMarginSpinBox.value
+        try:
+            self.engine.prepare()
+        except (ValueError, OSError, RuntimeError) as e:  # e.g. empty ROI or failed export
+            self.engine = None
+            slicer.util.errorDisplay(str(e), windowTitle='Registration error')
+            return
+        with self.logic.timePhase(self.engine.record, 'validation'):
+            validParameters = self.validateParameters()
+        if not validParameters:
+            self.engine = None
+            return
         print('\n\n')
-        self.printCommandLine()
-        tIni = time.time()
+        self.engine.printCommandLine()
+
+        self.logTextEdit.clear()
+        self.setProcessRunning(True)
+        self.engine.start(onFinished=self.onEngineFinished,
+                          onOutput=self.onEngineOutput,
+                          onProgress=self.onEngineProgress)
+
+
+    def onPreviewToggled(self, checked):
+        if checked:
+            self.schedulePreview()
+        else:
+            self.removePreview()
+
+
+    def schedulePreview(self):
+        if not self.previewCheckBox.isChecked(): return
+        self.previewTimer.start()  # restarted by each change
+
+
+    def runPreview(self):
+        self.readParameters()
+        if self.referenceVolumeNode is None or self.floatingVolumeNode is None: return
+        if self.engine is not None or self.cascade is not None: return  # full resolution running
+        if self.previewEngine is not None:
+            self.previewEngine.cancel()
+
+        engine = BlockmatchingEngine(self.logic,
+                                     self.referenceVolumeNode,
+                                     self.floatingVolumeNode,
+                                     parameters=self.getParameters(),
+                                     initialTransform=self.initialTransformNode)
+        engine.previewLevel = self.previewLevelSpinBox.value
+        engine.requireResultVolume = False
+        self.previewEngine = engine
+        self.previewLabel.text = 'Running...'
+        engine.start(onFinished=self.onPreviewFinished)
+
+
+    def onPreviewFinished(self, engine):
+        if engine is not self.previewEngine: return  # replaced by a newer preview
+        self.previewEngine = None
+        if engine.status != 'done':
+            self.previewLabel.text = 'Preview {}'.format(engine.status)
+            if engine.status == 'failed':
+                self.logTextEdit.appendPlainText(engine.getErrorMessage())
+            return
+        self.previewLabel.text = '{:.1f} s'.format(engine.elapsedTime)
+
+        # Update the transform of the previous preview in place
+        previewTransformNode = engine.loadResultTransform(name='Blockmatching preview',
+                                                          transformNode=self.previewTransformNode)
+        if previewTransformNode is not self.previewTransformNode:
+            self.removePreviewTransform()
+            self.previewTransformNode = previewTransformNode
+        elif engine.floating is not self.previewFloatingNode:
+            self.restorePreviewFloating()
+
+        # The transform of the floating, e.g. an initial alignment, is restored with the preview
+        if self.previewFloatingNode is None:
+            self.previewFloatingNode = engine.floating
+            self.previewFloatingTransformID = engine.floating.GetTransformNodeID()
+        engine.floating.SetAndObserveTransformNodeID(self.previewTransformNode.GetID())
+
+
+    def restorePreviewFloating(self):
+        floatingNode = self.previewFloatingNode
+        if floatingNode is None: return
+        previewTransformID = self.previewTransformNode.GetID() if self.previewTransformNode else None
+        if floatingNode.GetTransformNodeID() == previewTransformID:
+            floatingNode.SetAndObserveTransformNodeID(self.previewFloatingTransformID)
+        self.previewFloatingNode = None
+        self.previewFloatingTransformID = None
+
+
+    def removePreviewTransform(self):
+        if self.previewTransformNode is None: return
+        self.restorePreviewFloating()
+        slicer.mrmlScene.RemoveNode(self.previewTransformNode)
+        self.previewTransformNode = None
+
+
+    def removePreview(self):
+        self.previewTimer.stop()
+        if self.previewEngine is not None:
+            self.previewEngine.cancel()
+            self.previewEngine = None
+        self.removePreviewTransform()
+        self.previewLabel.text = ''
+
+
+    def onBatch(self):
+        if self.batch is not None and self.batch.isRunning():
+            self.batch.cancel()
+            return
+
+        self.readParameters()
+        if self.referenceVolumeNode is None:
+            slicer.util.errorDisplay('A reference volume must be selected')
+            return
+        floatingNodes = self.batchFloatingSelector.checkedNodes()
+        if not floatingNodes:
+            slicer.util.errorDisplay('No floating volumes are checked')
+            return
+
+        # Pool processes share the cores, so no parallelism is passed.
+        # The floating thresholds are those of the selected floating volume.
+        parameters = self.getParameters().copy(parallelism=None, floatingThresholds=None)
+
+        self.batchButton.text = 'Cancel batch'
+        self.numberOfBatchJobs = len(floatingNodes)
+        self.numberOfFinishedBatchJobs = 0
+        self.batch = self.logic.registerFloatings(
+            self.referenceVolumeNode,
+            floatingNodes,
+            parameters=parameters,
+            initialTransform=self.initialTransformNode,
+            maxProcesses=self.batchProcessesSpinBox.value,
+            onJobFinished=self.onBatchJobFinished,
+            onFinished=self.onBatchFinished)
+
+
+    def onBatchJobFinished(self, job):
+        if job.resultTransformNode is not None:
+            job.floating.SetAndObserveTransformNodeID(job.resultTransformNode.GetID())
+        # Jobs might finish before registerFloatings returns, e.g. if cached
+        self.numberOfFinishedBatchJobs += 1
+        self.batchStatusLabel.text = '{}/{} jobs finished'.format(
+            self.numberOfFinishedBatchJobs, self.numberOfBatchJobs)
+
+
+    def onBatchFinished(self, batch):
+        self.batchButton.text = 'Run batch'
+        failed = [job for job in batch.jobs if job.status == 'failed']
+        self.batchStatusLabel.text = '{} jobs finished, {} failed'.format(
+            len(batch.jobs), len(failed))
+
+
+    def onPropagate(self):
+        self.readParameters()
+        if self.referenceVolumeNode is None or self.resultTransformNode is None:
+            slicer.util.errorDisplay('A reference volume and a result transform must be selected')
+            return
+        volumeNodes = self.propagateVolumesSelector.checkedNodes()
+        if not volumeNodes:
+            slicer.util.errorDisplay('No volumes are checked')
+            return
         try:
-            qt.QApplication.setOverrideCursor(qt.Qt.WaitCursor)
-            p = subprocess.Popen(self.commandLineList, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            output = p.communicate()
-            print('\nBlockmatching returned {}'.format(p.returncode))
-            if p.returncode != 0 or not self.outputsExist():
-                # Newer versions of blockmatching return 0
-                # Apparently it always returns 0 :(
-                qt.QApplication.restoreOverrideCursor()
-                errorMessage = ''
-                if not self.outputsExist():
-                    errorMessage += 'Output volume not written on the disk\n\n'
-                errorMessage += output[1]
-                slicer.util.errorDisplay(errorMessage, windowTitle="Registration error")
+            self.logic.propagateTransform(self.resultTransformNode,
+                                          volumeNodes,
+                                          self.referenceVolumeNode,
+                                          harden=self.propagateHardenCheckBox.isChecked())
+        except ValueError as e:
+            slicer.util.errorDisplay(str(e))
+
+
+    def onCancel(self):
+        if self.cascade is not None:
+            print('\nCancelling cascade...')
+            self.cascade.cancel()
+        if self.engine is None: return
+        print('\nCancelling registration...')
+        self.engine.cancel()
+
+
+    def startCascade(self):
+        stages = self.logic.getCascadeStages(self.getSelectedTransformationType(),
+                                             self.pyramidHighestSpinBox.value,
+                                             self.pyramidLowestSpinBox.value)
+        self.setProcessRunning(True)
+        self.tIni = time.time()
+        self.cascadeResultNodes = self.resultVolumeNode, self.resultTransformNode
+        self.cascade = self.logic.registerCascade(
+            self.referenceVolumeNode,
+            self.floatingVolumeNode,
+            stages,
+            parameters=self.getParameters(),
+            initialTransform=self.initialTransformNode,
+            roi=self.roiSelector.currentNode(),
+            roiMargin=self.roiMarginSpinBox.value,
+            requireResultVolume=self.resultVolumeNode is not None,
+            onFinished=self.onCascadeFinished)
+
+
+    def onCascadeFinished(self, cascade):
+        self.cascade = None
+        self.setProcessRunning(False)
+        lastJob = cascade.jobs[-1]
+        if lastJob.status == 'cancelled':
+            print('\nCascade cancelled')
+        elif lastJob.status != 'done':
+            slicer.util.errorDisplay(lastJob.getErrorMessage(), windowTitle="Registration error")
+        else:
+            tFin = time.time()
+            print('\nCascade completed in {:.2f} seconds'.format(tFin - self.tIni))
+            lastJob.resultVolumeNode, lastJob.resultTransformNode = self.cascadeResultNodes
+            self.loadResults(lastJob)
+            if self.logic.getCleanupIntermediates():
+                for job in cascade.jobs:
+                    job.removeIntermediateFiles()
+
+
+    def onEngineFinished(self, engine):
+        self.engine = None
+        self.setProcessRunning(False)
+        if engine.status == 'cancelled':
+            print('\nRegistration cancelled')
+        elif engine.status != 'done':
+            print('\nBlockmatching returned {}'.format(engine.returnCode))
+            self.logCollapsibleButton.collapsed = False
+            slicer.util.errorDisplay(engine.getErrorMessage() + '\nSee the log for the full output',
+                                     windowTitle="Registration error")
+        else:
+            print('\nRegistration completed in {:.2f} seconds'.format(engine.elapsedTime))
+            self.loadResults(engine)
+            if self.logic.getCleanupIntermediates():
+                # After the engine has read the log for the history
+                qt.QTimer.singleShot(0, engine.removeIntermediateFiles)
+
+
+    def onEngineOutput(self, line, stream):
+        line = line.rstrip('\n')
+        if stream == 'stderr':
+            line = '[stderr] ' + line
+        self.logTextEdit.appendPlainText(line)
+
+
+    def onEngineProgress(self, engine):
+        if engine.level is None: return
+        highestLevel = engine.parameters.pyramidHighestLevel
+        lowestLevel = engine.parameters.pyramidLowestLevel
+        self.progressBar.setRange(0, highestLevel - lowestLevel + 1)
+        self.progressBar.value = max(0, highestLevel - engine.level)
+        progressFormat = 'Level {}'.format(engine.level)
+        if engine.iteration is not None:
+            progressFormat += ', iteration {}'.format(engine.iteration)
+        self.progressBar.format = progressFormat
+
+
+    def isProcessRunning(self):
+        return self.engine is not None or self.cascade is not None
+
+
+    def setProcessRunning(self, running):
+        self.applyButton.setDisabled(running)
+        self.batchButton.setDisabled(running)
+        self.cascadeCheckBox.setDisabled(running)
+        self.progressFrame.setVisible(running)
+        self.cancelButton.setEnabled(running)
+        self.progressBar.setRange(0, 0)  # busy until a pyramid level is reported
+        self.progressBar.format = '%p%'
+
+
+
+class BlockmatchingLogic(ScriptedLoadableModuleLogic):
+
+    def __init__(self, blockmatchingPath=BLOCKMATCHING_PATH):
+        ScriptedLoadableModuleLogic.__init__(self)
+        self.blockmatchingPath = blockmatchingPath
+        self.exportCache = collections.OrderedDict()  # (ID, MTime, geometry): path
+        self.niftiHeaderCache = {}  # (path, mtime, size): header
+        self.statisticsCache = {}  # node ID: statistics
+        self.statisticsObservers = {}  # node ID: (node, observer tag)
+        self.fileHashCache = {}  # (path, mtime, size): hash
+        self.secondsPerCostCache = {}
+
+    def makeCommandLineList(self, refPath, floPath, resPath, resultTransformPath,
+                            parameters, initialTransformPath=None, cmdPath=None,
+                            logPath=None):
+        cmd = [self.blockmatchingPath]
+        cmd += ['-reference', refPath]
+        cmd += ['-floating', floPath]
+        cmd += ['-result', resPath]
+        cmd += ['-result-transformation', resultTransformPath]
+        cmd += ['-pyramid-highest-level', str(parameters.pyramidHighestLevel)]
+        cmd += ['-pyramid-lowest-level', str(parameters.pyramidLowestLevel)]
+        cmd += ['-transformation-type', parameters.trsfType]
+        if cmdPath is not None:
+            cmd += ['-command-line', cmdPath]
+        if logPath is not None:
+            cmd += ['-logfile', logPath]
+        cmd += ['-print-time']
+
+        if parameters.gaussianFiltering:
+            cmd += ['-pyramid-gaussian-filtering']
+
+        for flag, value in (('-block-size', parameters.blockSize),
+                            ('-block-spacing', parameters.blockSpacing),
+                            ('-block-border', parameters.blockBorder),
+                            ('-search-neighborhood-half-size', parameters.searchHalfSize),
+                            ('-search-neighborhood-step', parameters.searchStep)):
+            if value is not None:
+                cmd += [flag] + [str(n) for n in value]
+        if parameters.floatingSelectionFraction is not None:
+            cmd += ['-floating-selection-fraction', str(parameters.floatingSelectionFraction)]
+
+        if parameters.referenceThresholds is not None:
+            cmd += ['-reference-low-threshold', str(parameters.referenceThresholds[0])]
+            cmd += ['-reference-high-threshold', str(parameters.referenceThresholds[1])]
+        if parameters.floatingThresholds is not None:
+            cmd += ['-floating-low-threshold', str(parameters.floatingThresholds[0])]
+            cmd += ['-floating-high-threshold', str(parameters.floatingThresholds[1])]
+        if parameters.referenceRemovedFraction is not None:
+            cmd += ['-reference-removed-fraction', str(parameters.referenceRemovedFraction)]
+        if parameters.floatingRemovedFraction is not None:
+            cmd += ['-floating-removed-fraction', str(parameters.floatingRemovedFraction)]
+
+        if initialTransformPath is not None:
+            cmd += ['-initial-transformation', initialTransformPath]
+            cmd += ['-composition-with-initial']
+
+        if parameters.parallelism is not None:
+            cmd += self.getParallelismArguments(**parameters.parallelism)
+        return cmd
+
+
+    def getParallelismArguments(self, parallel=None, maxChunks=None,
+                                parallelismType=None, ompScheduling=None):
+        """
+        None or 'default' values are not passed, so that blockmatching uses
+        its own defaults.
+        """
+        if parallel is False or (maxChunks is not None and maxChunks <= 1):
+            return ['-no-parallel']
+
+        args = []
+        if maxChunks is not None:
+            args += ['-max-chunks', str(maxChunks)]
+        if parallelismType not in (None, 'default'):
+            args += ['-parallelism-type', parallelismType]
+        if ompScheduling not in (None, 'default'):
+            args += ['-omp-scheduling', ompScheduling]
+        if parallel or args:
+            args = ['-parallel'] + args
+        return args
+
+
+    def getPerformanceSettingsKey(self):
+        # The best parameters depend on the machine
+        return 'Blockmatching/Parallelism/{}-{}cores'.format(platform.node(), self.getNumberOfCores())
+
+
+    def getCachedParallelism(self):
+        value = qt.QSettings().value(self.getPerformanceSettingsKey())
+        if not value:
+            return None
+        return json.loads(value)
+
+
+    def setCachedParallelism(self, parallelism):
+        qt.QSettings().setValue(self.getPerformanceSettingsKey(), json.dumps(parallelism))
+
+
+    def getCalibrationCandidates(self, numberOfCores=None):
+        if numberOfCores is None:
+            numberOfCores = self.getNumberOfCores()
+        candidates = []
+        for maxChunks in sorted(set([numberOfCores, 2 * numberOfCores, 4 * numberOfCores])):
+            for ompScheduling in 'static', 'dynamic', 'guided':
+                candidates.append(dict(parallel=True,
+                                       maxChunks=maxChunks,
+                                       ompScheduling=ompScheduling))
+        return candidates
+
+
+    def calibrateParallelism(self, reference, floating, trsfType='affine',
+                             pyramidLevel=3, onFinished=None, wait=False):
+        """
+        Runs a short registration at a single pyramid level for each
+        candidate in getCalibrationCandidates(), one at a time, and caches
+        the fastest one in the Slicer settings.
+        onFinished is called with the chosen parallelism dictionary, or None
+        if all the runs failed.
+        """
+        candidates = self.getCalibrationCandidates()
+        jobs = []
+        for parallelism in candidates:
+            job = RegistrationJob(reference, floating)
+            job.parallelism = parallelism
+            jobs.append(job)
+
+        def onCalibrationFinished(batch):
+            doneJobs = [job for job in batch.jobs if job.status == 'done']
+            if not doneJobs:
+                parallelism = None
+            else:
+                fastestJob = min(doneJobs, key=lambda job: job.elapsedTime)
+                parallelism = fastestJob.parallelism
+                self.setCachedParallelism(parallelism)
+                print('Fastest parallelism: {} ({:.2f} seconds)'.format(parallelism, fastestJob.elapsedTime))
+            if onFinished is not None:
+                onFinished(parallelism)
+
+        parameters = BlockmatchingParameters(trsfType=trsfType,
+                                             pyramidHighestLevel=pyramidLevel,
+                                             pyramidLowestLevel=pyramidLevel)
+        return self.registerBatch(jobs,
+                                  parameters=parameters,
+                                  maxProcesses=1,
+                                  loadResults=False,
+                                  onFinished=onCalibrationFinished,
+                                  wait=wait,
+                                  useCache=False)
+
+
+    def getNumberOfCores(self):
+        try:
+            return multiprocessing.cpu_count()
+        except NotImplementedError:
+            return 1
+
+
+    def getBatchPoolSize(self, numberOfJobs, numberOfCores=None):
+        """
+        Blockmatching does not scale linearly with the number of threads, so
+        it is faster to run several processes with a few chunks each than
+        one process with all the cores. Two cores per process is a good
+        trade-off between throughput and memory usage.
+        """
+        if numberOfCores is None:
+            numberOfCores = self.getNumberOfCores()
+        poolSize = max(1, numberOfCores // 2)
+        return max(1, min(poolSize, numberOfJobs))
+
+
+    def getChunksPerProcess(self, poolSize, numberOfCores=None):
+        if numberOfCores is None:
+            numberOfCores = self.getNumberOfCores()
+        return max(1, numberOfCores // poolSize)
+
+
+    def registerBatch(self, jobs, parameters=None, maxProcesses=None,
+                      outputDirectory=None, loadResults=True, onJobFinished=None,
+                      onFinished=None, wait=False, useCache=True):
+        """
+        Registers a list of RegistrationJob running at most maxProcesses
+        blockmatching processes at the same time.
+
+        If loadResults is True, the result transform of each job is loaded
+        into the scene as soon as the job finishes. Otherwise, results are
+        only written to outputDirectory (the temporary directory by default).
+        If useCache is True, jobs already in the results cache are not run.
+
+        Example from the Python console:
+        >>> logic = slicer.modules.BlockmatchingWidget.logic
+        >>> jobs = [RegistrationJob(atlas, subject) for subject in subjects]
+        >>> parameters = BlockmatchingParameters(trsfType='affine')
+        >>> batch = logic.registerBatch(jobs, parameters=parameters, wait=True)
+        """
+        batch = BlockmatchingBatch(self,
+                                   jobs,
+                                   parameters=parameters,
+                                   maxProcesses=maxProcesses,
+                                   outputDirectory=outputDirectory,
+                                   loadResults=loadResults,
+                                   onJobFinished=onJobFinished,
+                                   onFinished=onFinished,
+                                   useCache=useCache)
+        batch.start()
+        if wait:
+            batch.wait()
+        return batch
+
+
+    def registerFloatings(self, reference, floatings, parameters=None, initialTransform=None,
+                          outputDirectory=None, **batchParameters):
+        """
+        Registers each of floatings to reference on a shared pool of
+        processes (see registerBatch). The reference is exported and hashed
+        once before any job starts, so all the jobs read the same file.
+
+        blockmatching has no option to read a precomputed pyramid, so each
+        process still builds the reference pyramid.
+
+        Example from the Python console:
+        >>> batch = logic.registerFloatings(atlas, subjects, wait=True)
+        """
+        if outputDirectory is None:
+            outputDirectory = str(slicer.util.tempDirectory())
+        tIni = time.time()
+        referencePath = self.getVolumePathOnDisk(reference, outputDirectory)
+        self.getFileHash(referencePath)
+        print('Reference ready in {:.2f} seconds: {}'.format(time.time() - tIni, referencePath))
+
+        jobs = [RegistrationJob(reference, floating, initialTransform=initialTransform)
+                for floating in floatings]
+        return self.registerBatch(jobs,
+                                  parameters=parameters,
+                                  outputDirectory=outputDirectory,
+                                  **batchParameters)
+
+
+    def getCascadeStages(self, trsfType, pyramidHighestLevel, pyramidLowestLevel):
+        """
+        Returns a list of (trsfType, pyramidHighestLevel, pyramidLowestLevel)
+        from rigid up to trsfType. Each stage starts one level lower than the
+        previous one, as the coarse levels have already been registered.
+        """
+        trsfTypes = [t.lower() for t in TRANSFORMATIONS]
+        finalIndex = trsfTypes.index(trsfType.lower())
+        stageTypes = [t for t in CASCADE_TRANSFORMATIONS if trsfTypes.index(t) < finalIndex]
+        stageTypes.append(trsfType.lower())
+        stages = []
+        for i, stageType in enumerate(stageTypes):
+            highestLevel = max(pyramidLowestLevel, pyramidHighestLevel - i)
+            stages.append((stageType, highestLevel, pyramidLowestLevel))
+        return stages
+
+
+    def registerCascade(self, reference, floating, stages, parameters=None,
+                        initialTransform=None, roi=None, roiMargin=ROI_DEFAULT_MARGIN_MM,
+                        requireResultVolume=False, onStageFinished=None, onFinished=None,
+                        wait=False, **batchParameters):
+        """
+        Registers reference and floating once per stage in stages (see
+        getCascadeStages), passing the result of each stage as the initial
+        transformation of the next one. The other options are taken from
+        parameters. If requireResultVolume is True, the last stage fails
+        if blockmatching does not write the result image.
+        """
+        cascade = BlockmatchingCascade(self,
+                                       reference,
+                                       floating,
+                                       stages,
+                                       parameters=parameters,
+                                       initialTransform=initialTransform,
+                                       roi=roi,
+                                       roiMargin=roiMargin,
+                                       requireResultVolume=requireResultVolume,
+                                       onStageFinished=onStageFinished,
+                                       onFinished=onFinished,
+                                       **batchParameters)
+        cascade.start()
+        if wait:
+            cascade.wait()
+        return cascade
+
+
+    def getVolumePathOnDisk(self, volume, directory, dateTime=None):
+        """
+        Returns a NIfTI path for a volume node, saving it to directory if
+        needed. Paths are returned unchanged.
+        """
+        if isinstance(volume, str):
+            return volume
+        if not self.needsExport(volume):
+            return self.getNodeFilepath(volume)
+        return self.exportVolume(volume, directory, dateTime=dateTime)
+
+
+    def needsExport(self, volumeNode):
+        """
+        True if the node is not stored in an up-to-date NIfTI file
+        """
+        path = self.getNodeFilepath(volumeNode)
+        upToDate = path and os.path.isfile(path) and not volumeNode.GetModifiedSinceRead()
+        return not (upToDate and self.hasNiftiExtension(path))
+
+
+    def getExportCacheKey(self, volumeNode):
+        matrix = vtk.vtkMatrix4x4()
+        volumeNode.GetIJKToRASMatrix(matrix)
+        geometry = tuple(self.getNumpyMatrixFromVTKMatrix(matrix).ravel())
+        return volumeNode.GetID(), volumeNode.GetImageData().GetMTime(), geometry
+
+
+    def exportVolume(self, volumeNode, directory, dateTime=None):
+        """
+        Writes the volume to a NIfTI file, reusing a previous export if
+        neither the voxels, the geometry nor the compact inputs setting have
+        changed since then
+        """
+        compact = self.getCompactInputs()
+        key = self.getExportCacheKey(volumeNode) + (compact,)
+        path = self.exportCache.get(key)
+        if path is not None and os.path.isfile(path):
+            self.exportCache.move_to_end(key)
+            return path
+
+        # Exports of older voxels or geometry of this node are outdated, while
+        # cropped or downsampled exports of the current ones are kept
+        nodeID, mTime, geometry = key[:3]
+        for oldKey in [k for k in self.exportCache if k[0] == nodeID and k[1:3] != (mTime, geometry)]:
+            self.removeCachedExport(oldKey)
+
+        path = self.getTempPath(directory,
+                                '.nii',
+                                filename=volumeNode.GetName(),
+                                dateTime=dateTime)
+        array = slicer.util.arrayFromVolume(volumeNode)
+        compactType = self.getCompactDataType(array) if compact else None
+        if compactType is not None:
+            array = array.astype(compactType)
+        if array.ndim == 3 and array.dtype.str[1:] in NIFTI_DATA_TYPES.values():
+            self.writeVolumeArray(volumeNode, array, path)
+        else:  # e.g. vector volumes
+            slicer.util.saveNode(volumeNode, path)
+        del array
+        self.exportCache[key] = path
+        self.evictExportCache()
+        return path
+
+
+    def getCropExtent(self, volumeNode, roi, margin=ROI_DEFAULT_MARGIN_MM):
+        """
+        Returns [i0, i1, j0, j1, k0, k1] (stop indices excluded) of the voxels
+        of volumeNode inside the RAS bounding box of roi, a markups ROI or a
+        segmentation node, grown by margin millimeters
+        """
+        bounds = [0] * 6
+        roi.GetRASBounds(bounds)
+        if bounds[0] > bounds[1]:
+            raise ValueError('{} is empty'.format(roi.GetName()))
+        corners = np.array([[x, y, z, 1]
+                            for x in bounds[:2]
+                            for y in bounds[2:4]
+                            for z in bounds[4:]])
+        rasToIJK = vtk.vtkMatrix4x4()
+        volumeNode.GetRASToIJKMatrix(rasToIJK)
+        ijkCorners = corners.dot(self.getNumpyMatrixFromVTKMatrix(rasToIJK).T)[:, :3]
+
+        dimensions = volumeNode.GetImageData().GetDimensions()
+        marginVoxels = np.ceil(margin / np.array(volumeNode.GetSpacing()))
+        start = np.floor(ijkCorners.min(axis=0) - marginVoxels).astype(int)
+        stop = np.ceil(ijkCorners.max(axis=0) + marginVoxels).astype(int) + 1
+        start = np.clip(start, 0, dimensions)
+        stop = np.clip(stop, 0, dimensions)
+        if np.any(stop - start < 1):
+            raise ValueError('{} does not overlap {}'.format(roi.GetName(), volumeNode.GetName()))
+        return [int(n) for pair in zip(start, stop) for n in pair]
+
+
+    def exportCroppedVolume(self, volumeNode, extent, directory, dateTime=None):
+        """
+        Writes the voxels of volumeNode inside extent to a NIfTI file. The
+        origin is moved so that the cropped image keeps its physical position,
+        therefore transforms estimated on the cropped images are also valid
+        for the full ones.
+        """
+        compact = self.getCompactInputs()
+        key = self.getExportCacheKey(volumeNode) + (tuple(extent), compact)
+        path = self.exportCache.get(key)
+        if path is not None and os.path.isfile(path):
+            self.exportCache.move_to_end(key)
+            return path
+
+        i0, i1, j0, j1, k0, k1 = extent
+        array = slicer.util.arrayFromVolume(volumeNode)[k0:k1, j0:j1, i0:i1]
+        compactType = self.getCompactDataType(array) if compact else None
+        if compactType is not None:
+            array = array.astype(compactType)
+
+        path = self.getTempPath(directory,
+                                '.nii',
+                                filename='{}_cropped'.format(volumeNode.GetName()),
+                                dateTime=dateTime)
+        self.writeVolumeArray(volumeNode, array, path, start=(i0, j0, k0))
+        del array
+        self.exportCache[key] = path
+        self.evictExportCache()
+        return path
+
+
+    def getDownsamplingFactors(self, volumeNode, level):
+        """
+        Integer (I, J, K) factors that bring the volume close to the shape of
+        the pyramid level
+        """
+        shapesMap = self.getPyramidShapesMap(volumeNode)
+        level = min(level, max(shapesMap))
+        return [max(1, int(round(float(n) / max(1, m))))
+                for n, m in zip(shapesMap[0], shapesMap[level])]
+
+
+    def exportDownsampledVolume(self, volumeNode, level, directory, dateTime=None):
+        """
+        Writes the volume averaged over blocks of voxels so that its shape is
+        close to the one of the pyramid level. The physical extent is
+        kept, so transforms estimated on the downsampled images are valid for
+        the full ones.
+        """
+        factors = self.getDownsamplingFactors(volumeNode, level)
+        key = self.getExportCacheKey(volumeNode) + (('downsampled', tuple(factors)),)
+        path = self.exportCache.get(key)
+        if path is not None and os.path.isfile(path):
+            self.exportCache.move_to_end(key)
+            return path
+
+        array = self.downsampleArray(slicer.util.arrayFromVolume(volumeNode), factors)
+
+        ijkToRAS = vtk.vtkMatrix4x4()
+        volumeNode.GetIJKToRASMatrix(ijkToRAS)
+        ijkToRAS = self.getNumpyMatrixFromVTKMatrix(ijkToRAS)
+        # The center of the first block is the new origin
+        ijkToRAS[:3, 3] = ijkToRAS.dot([(f - 1) / 2. for f in factors] + [1])[:3]
+        ijkToRAS[:3, :3] = ijkToRAS[:3, :3] * factors
+
+        path = self.getTempPath(directory,
+                                '.nii',
+                                filename='{}_level_{}'.format(volumeNode.GetName(), level),
+                                dateTime=dateTime)
+        self.writeNIFTI(path, array, ijkToRAS)
+        del array
+        self.exportCache[key] = path
+        self.evictExportCache()
+        return path
+
+
+    def downsampleArray(self, array, factors):
+        """
+        Averages a (K, J, I) array over blocks of (I, J, K) factors voxels.
+        Voxels that do not fill a whole block at the end of each axis are
+        dropped.
+        """
+        fi, fj, fk = [min(f, n) for f, n in zip(factors, reversed(array.shape))]
+        K, J, I = [n // f * f for n, f in zip(array.shape, (fk, fj, fi))]
+        blocks = array[:K, :J, :I].reshape(K // fk, fk, J // fj, fj, I // fi, fi)
+        return blocks.mean(axis=(1, 3, 5), dtype=np.float32)
+
+
+    def writeVolumeArray(self, volumeNode, array, path, start=(0, 0, 0)):
+        """
+        Writes a (K, J, I) array with the geometry of volumeNode. start is the
+        index of the first voxel of array in the volume.
+        The voxels are read from the node, so its storage is not modified.
+        """
+        ijkToRAS = vtk.vtkMatrix4x4()
+        volumeNode.GetIJKToRASMatrix(ijkToRAS)
+        ijkToRAS = self.getNumpyMatrixFromVTKMatrix(ijkToRAS)
+        ijkToRAS[:3, 3] = ijkToRAS.dot(tuple(start) + (1,))[:3]
+        self.writeNIFTI(path, array, ijkToRAS)
+
+
+    def writeNIFTI(self, path, array, ijkToRAS):
+        """
+        Writes a (K, J, I) array to a NIfTI-1 file, with qform and sform
+        computed from the 4 x 4 IJK to RAS matrix
+        """
+        array = np.ascontiguousarray(array)
+        dataType = array.dtype.newbyteorder('<')
+        array = array.astype(dataType, copy=False)
+        header = self.makeNIFTIHeader(array.shape, dataType, ijkToRAS)
+        openFile = gzip.open if path.endswith('.gz') else open
+        with openFile(path, 'wb') as f:
+            f.write(header)
+            f.write(array.reshape(-1).view(np.uint8))  # no copy
+
+
+    def makeNIFTIHeader(self, shape, dataType, ijkToRAS):
+        """
+        Returns the header and the padding up to the voxels
+        """
+        codes = {value: key for key, value in NIFTI_DATA_TYPES.items()}
+        sizes = list(reversed(shape))
+        spacing = np.linalg.norm(ijkToRAS[:3, :3], axis=0)
+        direction = ijkToRAS[:3, :3] / spacing
+        qfac = 1
+        if np.linalg.det(direction) < 0:
+            qfac = -1
+            direction[:, 2] *= -1
+        b, c, d = self.getQuaternion(direction)
+
+        header = bytearray(NIFTI_VOX_OFFSET)
+        struct.pack_into('<i', header, 0, NIFTI_HEADER_SIZE)
+        header[38:39] = b'r'  # regular
+        struct.pack_into('<8h', header, 40, 3, sizes[0], sizes[1], sizes[2], 1, 1, 1, 1)
+        struct.pack_into('<2h', header, 70, codes[dataType.str[1:]], dataType.itemsize * 8)
+        struct.pack_into('<8f', header, 76, qfac, spacing[0], spacing[1], spacing[2], 1, 1, 1, 1)
+        struct.pack_into('<3f', header, 108, NIFTI_VOX_OFFSET, 1, 0)  # vox_offset, scl_slope, scl_inter
+        header[123:124] = struct.pack('<B', NIFTI_UNITS_MM)
+        struct.pack_into('<2h', header, 252, NIFTI_XFORM_SCANNER_ANAT, NIFTI_XFORM_SCANNER_ANAT)
+        struct.pack_into('<6f', header, 256, b, c, d, *ijkToRAS[:3, 3])
+        struct.pack_into('<12f', header, 280, *ijkToRAS[:3].ravel())
+        header[344:348] = b'n+1\x00'
+        return bytes(header)
+
+
+    def getQuaternion(self, rotation):
+        """
+        Returns (b, c, d) of the unit quaternion of a proper rotation matrix,
+        as in mat44_to_quatern of nifti1_io.c
+        """
+        (r11, r12, r13), (r21, r22, r23), (r31, r32, r33) = rotation
+        a = r11 + r22 + r33 + 1
+        if a > 0.5:
+            a = 0.5 * np.sqrt(a)
+            b = 0.25 * (r32 - r23) / a
+            c = 0.25 * (r13 - r31) / a
+            d = 0.25 * (r21 - r12) / a
+        else:
+            xd = 1 + r11 - (r22 + r33)
+            yd = 1 + r22 - (r11 + r33)
+            zd = 1 + r33 - (r11 + r22)
+            if xd > 1:
+                b = 0.5 * np.sqrt(xd)
+                c = 0.25 * (r12 + r21) / b
+                d = 0.25 * (r13 + r31) / b
+                a = 0.25 * (r32 - r23) / b
+            elif yd > 1:
+                c = 0.5 * np.sqrt(yd)
+                b = 0.25 * (r12 + r21) / c
+                d = 0.25 * (r23 + r32) / c
+                a = 0.25 * (r13 - r31) / c
             else:
-                tFin = time.time()
-                print('\nRegistration completed in {:.2f} seconds'.format(tFin - tIni))
-                self.repareResults()
-                self.loadResults()
-        except OSError as e:
-            print(e)
-            print('Is blockmatching correctly installed?')
+                d = 0.5 * np.sqrt(zd)
+                b = 0.25 * (r13 + r31) / d
+                c = 0.25 * (r23 + r32) / d
+                a = 0.25 * (r21 - r12) / d
+            if a < 0:
+                b, c, d = -b, -c, -d
+        return b, c, d
+
+
+    def getCompactDataType(self, array, chunkVoxels=STATISTICS_CHUNK_VOXELS):
+        """
+        Returns the smallest integer type that holds all the values of array
+        without loss, or None if there is none smaller than its type
+        """
+        if array.size == 0: return None
+        isFloat = np.issubdtype(array.dtype, np.floating)
+        flat = array.reshape(-1)
+        minValue = maxValue = None
+        for start in range(0, flat.size, chunkVoxels):
+            chunk = flat[start:start + chunkVoxels]
+            if isFloat and not np.all(np.floor(chunk) == chunk):  # also False for NaN
+                return None
+            chunkMin, chunkMax = chunk.min(), chunk.max()
+            minValue = chunkMin if minValue is None else min(minValue, chunkMin)
+            maxValue = chunkMax if maxValue is None else max(maxValue, chunkMax)
+        for dataType in COMPACT_DATA_TYPES:
+            if np.dtype(dataType).itemsize >= array.dtype.itemsize: break
+            info = np.iinfo(dataType)
+            if info.min <= minValue and maxValue <= info.max:
+                return dataType
+        return None
+
+
+    def getCompactInputs(self):
+        return qt.QSettings().value('Blockmatching/CompactInputs') in (True, 'true')
+
+
+    def setCompactInputs(self, value):
+        qt.QSettings().setValue('Blockmatching/CompactInputs', bool(value))
+
+
+    def getCompressionLevel(self):
+        """
+        0 means no compression
+        """
+        value = qt.QSettings().value('Blockmatching/CompressionLevel')
+        return 0 if value is None else int(value)
+
+
+    def setCompressionLevel(self, value):
+        qt.QSettings().setValue('Blockmatching/CompressionLevel', value)
+
+
+    def getImageExtension(self):
+        """
+        Extension of the images written by blockmatching
+        """
+        return '.nii.gz' if self.getCompressionLevel() > 0 else '.nii'
+
+
+    def getCleanupIntermediates(self):
+        return qt.QSettings().value('Blockmatching/CleanupIntermediates') in (True, 'true')
+
+
+    def setCleanupIntermediates(self, value):
+        qt.QSettings().setValue('Blockmatching/CleanupIntermediates', bool(value))
+
+
+    def removeExportedFile(self, path):
+        """
+        Removes path only if it was written by exportVolume, never the files
+        the volumes were loaded from
+        """
+        for key, exportedPath in list(self.exportCache.items()):
+            if exportedPath == path:
+                self.removeCachedExport(key)
+
+
+    def removeCachedExport(self, key):
+        path = self.exportCache.pop(key)
+        if os.path.isfile(path):
+            os.remove(path)
+
+
+    def evictExportCache(self, maxBytes=EXPORT_CACHE_MAX_BYTES):
+        """
+        Removes the least recently used exports until the cache fits in
+        maxBytes. The most recent export is always kept.
+        """
+        def getSize(path):
+            return os.path.getsize(path) if os.path.isfile(path) else 0
+
+        totalBytes = sum(getSize(path) for path in self.exportCache.values())
+        while totalBytes > maxBytes and len(self.exportCache) > 1:
+            oldestKey = next(iter(self.exportCache))
+            totalBytes -= getSize(self.exportCache[oldestKey])
+            self.removeCachedExport(oldestKey)
+
+
+    def newRunRecord(self):
+        record = {
+            'date': datetime.datetime.now().isoformat(),
+            'host': platform.node(),
+            'cores': self.getNumberOfCores(),
+            'blockmatching': self.blockmatchingPath,
+            'phases': {},
+            'cached': False,
+        }
+        blockmatchingMTime = self.getBlockmatchingMTime()
+        if blockmatchingMTime is not None:
+            record['blockmatchingMTime'] = blockmatchingMTime
+        return record
+
+
+    def getBlockmatchingMTime(self):
+        """
+        Proxy for the blockmatching version
+        """
+        if not os.path.isfile(self.blockmatchingPath): return None
+        return os.path.getmtime(self.blockmatchingPath)
+
+
+    @contextlib.contextmanager
+    def timePhase(self, record, phase):
+        tIni = time.time()
+        try:
+            yield
         finally:
-            qt.QApplication.restoreOverrideCursor()
+            phases = record['phases']
+            phases[phase] = phases.get(phase, 0) + time.time() - tIni
 
 
+    def finishRunRecord(self, record, commandLineList, status, logPath=None, output=None, append=True):
+        """
+        Adds the command line, status and pyramid level timings to the record
+        and appends it to the history file, unless append is False.
+        The timings are read from the logfile if it exists, otherwise from
+        the output, as blockmatching may print them to both.
+        """
+        record['status'] = status
+        record['commandLine'] = commandLineList
+        if logPath is not None and os.path.isfile(logPath):
+            with open(logPath) as f:
+                text = f.read()
+        else:
+            text = ''.join(output or [])
+        record['levels'] = self.parseLevelTimings(text)
+        if append:
+            self.appendRunHistory(record)
+
+
+    def parseLevelTimings(self, text):
+        """
+        Returns {level: seconds} from the -print-time output, assigning each
+        reported time to the last pyramid level mentioned before it
+        """
+        timePattern = re.compile(r'time[^0-9\n]*([0-9]+(?:\.[0-9]*)?)\s*(?:sec|s\b)', re.IGNORECASE)
+        timings = {}
+        level = None
+        for line in text.splitlines():
+            levelMatch = LEVEL_PATTERN.search(line)
+            if levelMatch:
+                level = int(levelMatch.group(1))
+            if 'total' in line.lower():
+                continue
+            timeMatch = timePattern.search(line)
+            if timeMatch and level is not None:
+                timings[level] = timings.get(level, 0) + float(timeMatch.group(1))
+        return {str(level): seconds for level, seconds in timings.items()}
+
+
+    def parseProgressLine(self, line):
+        """
+        Returns (level, iteration) from a line of the -verbose or -print-time
+        output. Values not found in the line are None.
+        """
+        levelMatch = LEVEL_PATTERN.search(line)
+        iterationMatch = ITERATION_PATTERN.search(line)
+        level = int(levelMatch.group(1)) if levelMatch else None
+        iteration = int(iterationMatch.group(1)) if iterationMatch else None
+        return level, iteration
+
+
+    def getHistoryPath(self):
+        return os.path.join(slicer.app.temporaryPath, HISTORY_FILENAME)
+
+
+    def appendRunHistory(self, record):
+        with open(self.getHistoryPath(), 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+
+    def readRunHistory(self):
+        historyPath = self.getHistoryPath()
+        if not os.path.isfile(historyPath):
+            return []
+        with open(historyPath) as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+
+    def getFileHash(self, path):
+        stat = os.stat(path)
+        key = path, stat.st_mtime, stat.st_size
+        if key not in self.fileHashCache:
+            sha = hashlib.sha1()
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(HASH_CHUNK_BYTES), b''):
+                    sha.update(chunk)
+            self.fileHashCache[key] = sha.hexdigest()
+        return self.fileHashCache[key]
+
+
+    def getRegistrationKey(self, commandLineList):
+        """
+        Identifies a registration by the blockmatching binary, the content of
+        its inputs and the parameters that change its results. Output paths
+        and parallelism options are ignored.
+        """
+        normalized = [commandLineList[0], self.getBlockmatchingMTime()]
+        args = iter(commandLineList[1:])
+        for arg in args:
+            if arg in INPUT_PATH_FLAGS:
+                normalized += [arg, self.getFileHash(next(args))]
+            elif arg in OUTPUT_PATH_FLAGS or arg in PARALLELISM_VALUE_FLAGS:
+                next(args)
+            elif arg not in PARALLELISM_FLAGS:
+                normalized.append(arg)
+        return hashlib.sha1(json.dumps(normalized).encode('utf-8')).hexdigest()
+
+
+    def getResultCacheDirectory(self):
+        return os.path.join(slicer.app.temporaryPath, 'BlockmatchingCache')
+
+
+    def getResultCacheMaxGB(self):
+        value = qt.QSettings().value('Blockmatching/ResultCacheMaxGB')
+        return RESULT_CACHE_DEFAULT_GB if value is None else int(value)
+
+
+    def setResultCacheMaxGB(self, value):
+        qt.QSettings().setValue('Blockmatching/ResultCacheMaxGB', value)
+        self.evictResultCache()
+
+
+    def getCachedResults(self, key):
+        """
+        Returns the cached result and result transform paths, or None
+        """
+        if self.getResultCacheMaxGB() == 0: return None
+        entryDir = os.path.join(self.getResultCacheDirectory(), key)
+        if not os.path.isdir(entryDir): return None
+        paths = [None, None]
+        for filename in os.listdir(entryDir):
+            if filename.startswith('result.'):
+                paths[0] = os.path.join(entryDir, filename)
+            elif filename.startswith('transform.'):
+                paths[1] = os.path.join(entryDir, filename)
+        if paths[1] is None: return None
+        os.utime(entryDir, None)  # most recently used
+        return tuple(paths)
+
+
+    def cacheResults(self, key, resultPath, resultTransformPath):
+        if self.getResultCacheMaxGB() == 0: return
+        entryDir = os.path.join(self.getResultCacheDirectory(), key)
+        if not os.path.isdir(entryDir):
+            os.makedirs(entryDir)
+        compressionLevel = self.getCompressionLevel()
+        for name, path in ('result', resultPath), ('transform', resultTransformPath):
+            if path is None or not os.path.isfile(path): continue
+            for extension in '.trsf', '.nii.gz', '.nii':
+                if path.endswith(extension): break
+            compress = compressionLevel > 0 and extension == '.nii'
+            if compress:
+                extension = '.nii.gz'
+            cachedPath = os.path.join(entryDir, name + extension)
+            for filename in os.listdir(entryDir):
+                if filename.startswith(name + '.'):
+                    os.remove(os.path.join(entryDir, filename))
+            if compress:
+                with open(path, 'rb') as fin, gzip.open(cachedPath, 'wb', compresslevel=compressionLevel) as fout:
+                    shutil.copyfileobj(fin, fout, HASH_CHUNK_BYTES)
+                continue
+            try:
+                os.link(path, cachedPath)  # no copy if on the same file system
+            except OSError:
+                shutil.copy(path, cachedPath)
+        self.evictResultCache()
+
+
+    def evictResultCache(self):
+        """
+        Removes the least recently used entries until the cache fits in
+        its disk budget
+        """
+        cacheDir = self.getResultCacheDirectory()
+        if not os.path.isdir(cacheDir): return
+        maxBytes = self.getResultCacheMaxGB() * 1024 ** 3
+
+        entries = []
+        totalBytes = 0
+        for key in os.listdir(cacheDir):
+            entryDir = os.path.join(cacheDir, key)
+            size = sum(os.path.getsize(os.path.join(entryDir, f)) for f in os.listdir(entryDir))
+            entries.append((os.path.getmtime(entryDir), size, entryDir))
+            totalBytes += size
+
+        for _, size, entryDir in sorted(entries):
+            if totalBytes <= maxBytes: break
+            shutil.rmtree(entryDir, ignore_errors=True)
+            totalBytes -= size
+
+
+    def getVolumeName(self, volume):
+        if isinstance(volume, str):
+            name = os.path.basename(volume)
+            for ext in '.nii.gz', '.img.gz', '.nii', '.hdr', '.img':
+                if name.endswith(ext):
+                    return name[:-len(ext)]
+            return name
+        return volume.GetName()
+
+
+    def isLinear(self, trsfType):
+        return trsfType.lower() != 'vectorfield'
+
+
+    def loadResultTransform(self, resultTransformPath, trsfType, name=None,
+                            cropExtent=None, dimensions=None, transformNode=None):
+        """
+        Linear transforms are in physical coordinates, so they do not depend on
+        cropping. Displacement fields are padded to the full reference grid.
+        If transformNode can store the result, it is updated in place so that
+        the nodes observing it are not reset.
+        """
+        if transformNode is not None and not self.canStoreTransform(transformNode, trsfType):
+            transformNode = None
+
+        if self.isLinear(trsfType):
+            matrix = self.readBaladinMatrix(resultTransformPath)
+            vtkMatrix = self.getVTKMatrixFromNumpyMatrix(matrix)
+            if transformNode is None:
+                transformNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLinearTransformNode')
+            transformNode.SetMatrixTransformFromParent(vtkMatrix)
+        else:
+            transformNode = self.loadRASDisplacementFieldTransform(resultTransformPath,
+                                                                   cropExtent=cropExtent,
+                                                                   dimensions=dimensions,
+                                                                   transformNode=transformNode)
+        if name is not None:
+            transformNode.SetName(name)
+        return transformNode
+
+
+    def canStoreTransform(self, transformNode, trsfType):
+        """
+        Plain transform nodes, e.g. created by the node selectors, store any
+        transform. Linear transform nodes only store linear transforms and
+        grid transform nodes only displacement fields.
+        """
+        if transformNode.GetClassName() == 'vtkMRMLTransformNode':
+            return True
+        if self.isLinear(trsfType):
+            return transformNode.IsA('vtkMRMLLinearTransformNode')
+        return transformNode.IsA('vtkMRMLGridTransformNode')
+
+
+    def updateVolumeFromFile(self, volumeNode, path):
+        """
+        Replaces the voxels and the geometry of volumeNode with those of the
+        image at path, keeping the node, its display and the views showing it.
+        SimpleITK is used for 2D and 3D images, as slicer.util.loadVolume
+        stacks 2D images.
+        Returns True if the geometry of the node has changed.
+        """
+        return self.updateVolumeFromImage(volumeNode, sitk.ReadImage(path))
+
+
+    def updateVolumeFromImage(self, volumeNode, image):
+        """
+        Same as updateVolumeFromFile for a SimpleITK image
+        """
+        origin, spacing, direction = self.get3DGeometry(image)
+        array = sitk.GetArrayFromImage(image)
+        if array.ndim == 2:
+            array = array[np.newaxis]
+
+        lpsToRas = np.diag((-1, -1, 1))
+        ijkToRAS = np.identity(4)
+        ijkToRAS[:3, :3] = lpsToRas.dot(direction).dot(np.diag(spacing))
+        ijkToRAS[:3, 3] = lpsToRas.dot(origin)
+
+        currentMatrix = vtk.vtkMatrix4x4()
+        volumeNode.GetIJKToRASMatrix(currentMatrix)
+        imageData = volumeNode.GetImageData()
+        currentDimensions = None if imageData is None else tuple(imageData.GetDimensions())
+        sameMatrix = np.allclose(self.getNumpyMatrixFromVTKMatrix(currentMatrix), ijkToRAS)
+        geometryChanged = not sameMatrix or currentDimensions != tuple(reversed(array.shape))
+
+        if not sameMatrix:
+            volumeNode.SetIJKToRASMatrix(self.getVTKMatrixFromNumpyMatrix(ijkToRAS))
+        slicer.util.updateVolumeFromArray(volumeNode, array)
+        if volumeNode.GetDisplayNode() is None:  # e.g. created by a node selector
+            volumeNode.CreateDefaultDisplayNodes()
+        return geometryChanged
+
+
+    def propagateTransform(self, transformNode, volumeNodes, reference, harden=False, maxThreads=None):
+        """
+        Resamples volumeNodes, which are aligned with the floating image, on
+        the grid of reference through the registration result transformNode.
+        Label maps use nearest neighbor interpolation. The transforms already
+        applied to volumeNodes are ignored.
+        The images are resampled by SimpleITK on a pool of threads, the scene
+        is only modified from the calling thread.
+        If harden is True, the nodes are overwritten, otherwise new nodes are
+        added. Returns the resampled nodes.
+
+        Example from the Python console:
+        >>> t2, flair, labels = logic.propagateTransform(transformNode, [t2, flair, labels], t1)
+        """
+        tIni = time.time()
+        transform = self.getSimpleITKTransform(transformNode)
+        size = reference.GetImageData().GetDimensions()
+        origin, spacing, direction = self.getLPSGeometry(reference)
+        images = [self.getSimpleITKImageFromVolume(volumeNode) for volumeNode in volumeNodes]
+
+        def resample(image, nearestNeighbor):
+            interpolator = sitk.sitkNearestNeighbor if nearestNeighbor else sitk.sitkLinear
+            return sitk.Resample(image, size, transform, interpolator,
+                                 origin, spacing, direction, 0, image.GetPixelID())
+
+        if maxThreads is None:
+            maxThreads = min(len(images), self.getNumberOfCores())
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, maxThreads)) as executor:
+            futures = [executor.submit(resample, image, volumeNode.IsA('vtkMRMLLabelMapVolumeNode'))
+                       for volumeNode, image in zip(volumeNodes, images)]
+            resampledImages = [future.result() for future in futures]
+        del images
+
+        resampledNodes = []
+        for volumeNode, image in zip(volumeNodes, resampledImages):
+            if harden:
+                resampledNode = volumeNode
+                resampledNode.SetAndObserveTransformNodeID(None)
+            else:
+                resampledNode = slicer.mrmlScene.AddNewNodeByClass(volumeNode.GetClassName(),
+                                                                   volumeNode.GetName() + '_resampled')
+                resampledNode.CreateDefaultDisplayNodes()
+                displayNode = volumeNode.GetDisplayNode()
+                if displayNode is not None and displayNode.GetColorNodeID():
+                    resampledNode.GetDisplayNode().SetAndObserveColorNodeID(displayNode.GetColorNodeID())
+            self.updateVolumeFromImage(resampledNode, image)
+            resampledNodes.append(resampledNode)
+        print('{} volumes resampled in {:.2f} seconds'.format(len(resampledNodes), time.time() - tIni))
+        return resampledNodes
+
+
+    def getLPSGeometry(self, volumeNode):
+        """
+        Origin, spacing and flattened direction of a volume node, as used by
+        SimpleITK
+        """
+        lpsToRas = np.diag((-1, -1, 1))
+        matrix = vtk.vtkMatrix4x4()
+        volumeNode.GetIJKToRASDirectionMatrix(matrix)
+        direction = self.getNumpyMatrixFromVTKMatrix(matrix)[:3, :3]
+        origin = lpsToRas.dot(volumeNode.GetOrigin())
+        direction = lpsToRas.dot(direction)
+        return origin.tolist(), list(volumeNode.GetSpacing()), direction.ravel().tolist()
+
+
+    def getSimpleITKImageFromVolume(self, volumeNode):
+        """
+        Copies the voxels of a scalar volume node into a 3D SimpleITK image
+        """
+        image = sitk.GetImageFromArray(slicer.util.arrayFromVolume(volumeNode))
+        origin, spacing, direction = self.getLPSGeometry(volumeNode)
+        image.SetOrigin(origin)
+        image.SetSpacing(spacing)
+        image.SetDirection(direction)
+        return image
+
+
+    def getSimpleITKTransform(self, transformNode):
+        """
+        Returns the transform from parent of transformNode in LPS, which maps
+        the points of the reference to the floating image as expected by
+        sitk.Resample. Linear transforms and the grid transforms loaded by
+        this module are supported.
+        """
+        lpsToRas = np.diag((-1, -1, 1))
+        if transformNode.IsLinear():
+            vtkMatrix = vtk.vtkMatrix4x4()
+            transformNode.GetMatrixTransformFromParent(vtkMatrix)
+            matrix = self.getNumpyMatrixFromVTKMatrix(vtkMatrix)
+            transform = sitk.AffineTransform(3)
+            transform.SetMatrix(lpsToRas.dot(matrix[:3, :3]).dot(lpsToRas).ravel().tolist())
+            transform.SetTranslation(lpsToRas.dot(matrix[:3, 3]).tolist())
+            return transform
+
+        gridTransform = transformNode.GetTransformFromParent()
+        if gridTransform is None or not gridTransform.IsA('vtkOrientedGridTransform'):
+            raise ValueError('{} is not a linear or grid transform'.format(transformNode.GetName()))
+        displacementGrid = gridTransform.GetDisplacementGrid()
+        i, j, k = displacementGrid.GetDimensions()
+        scalars = displacementGrid.GetPointData().GetScalars()
+        vectors = vtk.util.numpy_support.vtk_to_numpy(scalars).reshape(k, j, i, 3)
+        vectors = vectors * (-1, -1, 1)  # RAS to LPS, copied as the field is owned by SimpleITK
+        directionMatrix = self.getNumpyMatrixFromVTKMatrix(gridTransform.GetGridDirectionMatrix())
+
+        field = sitk.GetImageFromArray(vectors.astype(np.float64), isVector=True)
+        field.SetOrigin(lpsToRas.dot(displacementGrid.GetOrigin()).tolist())
+        field.SetSpacing(displacementGrid.GetSpacing())
+        field.SetDirection(lpsToRas.dot(directionMatrix[:3, :3]).ravel().tolist())
+        return sitk.DisplacementFieldTransform(field)
 
-class BlockmatchingLogic(ScriptedLoadableModuleLogic):
 
     def getNodeFilepath(self, node):
         storageNode = node.GetStorageNode()
@@ -655,6 +2512,10 @@ class BlockmatchingLogic(ScriptedLoadableModuleLogic):
             return storageNode.GetFileName()
 
 
+    def decodeProcessOutput(self, byteArray):
+        return bytes(byteArray.data()).decode('utf-8', 'replace')
+
+
     def getTempPath(self, directory, ext, length=10, filename=None, dateTime=None):
         if filename is None:
             filename = ''.join(random.choice(string.ascii_lowercase) for _ in range(length))
@@ -702,10 +2563,9 @@ class BlockmatchingLogic(ScriptedLoadableModuleLogic):
 
 
     def getNumpyMatrixFromVTKMatrix(self, vtkMatrix):
-        matrix = np.identity(4, np.float)
-        for row in range(4):
-            for col in range(4):
-                matrix[row,col] = vtkMatrix.GetElement(row,col)
+        size = 3 if isinstance(vtkMatrix, vtk.vtkMatrix3x3) else 4
+        matrix = np.identity(size, np.float64)
+        vtkMatrix.DeepCopy(matrix.ravel(), vtkMatrix)  # the ravel is a view
         return matrix
 
 
@@ -718,105 +2578,314 @@ class BlockmatchingLogic(ScriptedLoadableModuleLogic):
         else:
             raise ValueError('Unknown matrix dimensions.')
 
-        for row in range(dimensions + 1):
-            for col in range(dimensions + 1):
-                vtkMatrix.SetElement(row, col, numpyMatrix[row,col])
+        elements = np.ascontiguousarray(numpyMatrix, np.float64).ravel()
+        vtkMatrix.DeepCopy(elements)
         return vtkMatrix
 
 
+    def getNumpyMatricesFromVTKMatrices(self, vtkMatrices):
+        return np.array([self.getNumpyMatrixFromVTKMatrix(m) for m in vtkMatrices])
+
+
+    def getVTKMatricesFromNumpyMatrices(self, numpyMatrices):
+        return [self.getVTKMatrixFromNumpyMatrix(m) for m in numpyMatrices]
+
+
     def readBaladinMatrix(self, trsfPath):
         with open(trsfPath) as f:
-            lines = f.readlines()
-            numbersLines = lines[2:6]
-            matrix = np.loadtxt(numbersLines)
-            return matrix
+            lines = f.read().splitlines()
+        numbers = ' '.join(lines[2:6]).split()
+        return np.array(numbers, np.float64).reshape(4, 4)
+
+
+    def readBaladinMatrices(self, trsfPaths):
+        """
+        Returns a stack of matrices with shape (N, 4, 4)
+        """
+        return np.array([self.readBaladinMatrix(path) for path in trsfPaths])
+
+
+    def formatBaladinMatrix(self, matrix):
+        rowFormat = '{:13.8f}' * 4
+        matrixFormat = '\n'.join(['(', '08'] + 4 * [rowFormat] + [')'])
+        return matrixFormat.format(*np.asarray(matrix).ravel())
 
 
     def writeBaladinMatrix(self, transformNode, trsfPath):
         vtkMatrix = vtk.vtkMatrix4x4()
         transformNode.GetMatrixTransformFromParent(vtkMatrix)
         matrix = self.getNumpyMatrixFromVTKMatrix(vtkMatrix)
-        lines = []
-        lines.append('(')
-        lines.append('08')
-        for row in matrix:
-            line = []
-            for n in row:
-                line.append('{:13.8f}'.format(n))
-            lines.append(''.join(line))
-        lines.append(')')
-        line = '\n'.join(lines)
+        self.writeBaladinMatrixFromNumpy(matrix, trsfPath)
+
+
+    def writeBaladinMatrixFromNumpy(self, matrix, trsfPath):
         with open(trsfPath, 'w') as f:
-            f.write(line)
+            f.write(self.formatBaladinMatrix(matrix))
 
 
-    def loadRASDisplacementFieldTransform(self, displacementFieldPath):
-        _, transformNode = slicer.util.loadTransform(displacementFieldPath, returnNode=True)
-        transform = transformNode.GetTransformFromParent()
-        imageData = transform.GetDisplacementGrid()
-        arr = vtk.util.numpy_support.vtk_to_numpy(imageData.GetPointData().GetScalars())
-        arr[:, :2] *= -1
+    def writeBaladinMatrices(self, matrices, trsfPaths):
+        for matrix, trsfPath in zip(matrices, trsfPaths):
+            self.writeBaladinMatrixFromNumpy(matrix, trsfPath)
 
-        is2D = imageData.GetDimensions()[2] == 1
-        if is2D:
-            arr[:, 2] = 0  # TODO: rethink this
 
-        transformNode.Modified()  # necessary?
+    def loadRASDisplacementFieldTransform(self, displacementFieldPath, cropExtent=None, dimensions=None,
+                                          transformNode=None):
+        """
+        Builds the grid transform directly from the vectors read by
+        SimpleITK instead of going through slicer.util.loadTransform.
+        The loader flipped the vectors from LPS to RAS and we used to flip
+        them back, so the vectors are used as blockmatching writes them.
+        Only the grid geometry is converted from LPS to RAS.
+        If the reference was cropped to cropExtent, the field is put back in
+        the full reference grid of the given dimensions.
+        If transformNode is given, its transform is replaced instead of adding
+        a new node.
+        """
+        vectors, origin, spacing, direction = self.readDisplacementField(displacementFieldPath)
+        if cropExtent is not None:
+            vectors, origin = self.uncropDisplacementField(vectors, origin, spacing, direction,
+                                                           cropExtent, dimensions)
+        lpsToRas = np.diag((-1, -1, 1))
+        origin = lpsToRas.dot(origin)
+        direction = lpsToRas.dot(direction)
+        return self.getGridTransformNodeFromArray(vectors, origin, spacing, direction,
+                                                  transformNode=transformNode)
+
+
+    def uncropDisplacementField(self, vectors, origin, spacing, direction, cropExtent, dimensions):
+        """
+        Pads a field computed on a cropped reference with zero displacements
+        so that it covers the full reference grid
+        """
+        i0, i1, j0, j1, k0, k1 = cropExtent
+        if vectors.shape[:-1] != (k1 - k0, j1 - j0, i1 - i0):
+            print('The displacement field does not match the cropped reference, it is not padded')
+            return vectors, origin
+        fullVectors = np.zeros(tuple(reversed(dimensions)) + (3,), vectors.dtype)
+        fullVectors[k0:k1, j0:j1, i0:i1] = vectors
+        fullOrigin = origin - direction.dot(spacing * (i0, j0, k0))
+        return fullVectors, fullOrigin
+
+
+    def getRASFieldFromLPSField(self, displacementFieldPath, referenceNode):
+        """
+        Uses the geometry of the reference node, without writing the field
+        to the disk again. The vectors were flipped to LPS and flipped back
+        by the loader, so they are used as read, as in
+        loadRASDisplacementFieldTransform.
+        """
+        vectors = self.readDisplacementField(displacementFieldPath)[0]
+
+        directionMatrix = vtk.vtkMatrix4x4()
+        referenceNode.GetIJKToRASDirectionMatrix(directionMatrix)
+        direction = self.getNumpyMatrixFromVTKMatrix(directionMatrix)[:3, :3]
 
+        transformNode = self.getGridTransformNodeFromArray(vectors,
+                                                           referenceNode.GetOrigin(),
+                                                           referenceNode.GetSpacing(),
+                                                           direction)
         return transformNode
 
 
-    def getRASFieldFromLPSField(self, displacementFieldPath, referenceNode):
+    def readDisplacementField(self, displacementFieldPath):
+        """
+        Returns a (K, J, I, 3) array of vectors and the LPS geometry of the
+        field. 2D fields are stored as a single slice, with a zero z
+        component if they have only x and y components.
+        The image buffer is copied once into the array and released.
+        """
         image = sitk.ReadImage(displacementFieldPath)
-        arr = sitk.GetArrayFromImage(image)
-
-        is2D = len(arr.shape) == 3
+        geometry = self.get3DGeometry(image)
+        is2D = image.GetDimension() == 2
         if is2D:
-            arr = arr[:, :, None, :]  # add z voxels axis
-            zeros = np.zeros_like(arr[..., :1])  # add z component of the vectors
-            arr = np.concatenate((arr, zeros), axis=3)
-
-        arr[..., :2] *= -1  # RAS to LPS
-
-        # Create new image
-        referenceImage = su.PullFromSlicer(referenceNode.GetID())
-        newImage = sitk.GetImageFromArray(arr)
-        newImage.SetOrigin(referenceImage.GetOrigin())
-        newImage.SetDirection(referenceImage.GetDirection())
-        newImage.SetSpacing(referenceImage.GetSpacing())
-
-        # TODO: convert the image directly into a transform to save space and time
-        sitk.WriteImage(newImage, displacementFieldPath)
-        transformNode = slicer.util.loadTransform(displacementFieldPath)
+            view = sitk.GetArrayViewFromImage(image)
+            components = min(3, image.GetNumberOfComponentsPerPixel())
+            vectors = np.zeros((1,) + view.shape[:2] + (3,), view.dtype)
+            vectors[0, ..., :components] = view[..., :components]
+            del view
+        else:
+            vectors = sitk.GetArrayFromImage(image)
+        del image
+        return (vectors,) + geometry
+
+
+    def get3DGeometry(self, image):
+        """
+        Origin, spacing and direction of a SimpleITK image, padded to 3D
+        """
+        dimension = image.GetDimension()
+        origin = np.zeros(3)
+        origin[:dimension] = image.GetOrigin()
+        spacing = np.ones(3)
+        spacing[:dimension] = image.GetSpacing()
+        direction = np.identity(3)
+        direction[:dimension, :dimension] = np.reshape(image.GetDirection(), (dimension, dimension))
+        return origin, spacing, direction
+
+
+    def getGridTransformNodeFromArray(self, vectors, origin, spacing, direction, transformNode=None):
+        """
+        vectors is a (K, J, I, 3) array of RAS displacements. It is not
+        copied, so it must not be modified while the transform is in use.
+        """
+        shape = vectors.shape[:-1]
+        imageData = vtk.vtkImageData()
+        imageData.SetDimensions(shape[2], shape[1], shape[0])
+        imageData.SetOrigin(*origin)
+        imageData.SetSpacing(*spacing)
+        flatVectors = np.ascontiguousarray(vectors).reshape(-1, 3)
+        vtkArray = vtk.util.numpy_support.numpy_to_vtk(flatVectors, deep=False)
+        imageData.GetPointData().SetScalars(vtkArray)
+
+        directionMatrix = np.identity(4)
+        directionMatrix[:3, :3] = direction
+
+        gridTransform = slicer.vtkOrientedGridTransform()
+        gridTransform.SetDisplacementGridData(imageData)
+        gridTransform.SetGridDirectionMatrix(self.getVTKMatrixFromNumpyMatrix(directionMatrix))
+
+        if transformNode is None:
+            transformNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLGridTransformNode')
+        transformNode.SetAndObserveTransformFromParent(gridTransform)
         return transformNode
 
 
-    def getDataStreamFromVectorField(self, vectorfieldPath):
-        HEADER_SIZE = 256
-        with open(vectorfieldPath, mode='rb') as f:  # b is important -> binary
-            f.seek(HEADER_SIZE)
-            imageData = f.read()
-        imageData = np.fromstring(imageData, dtype=np.float32)
-        return imageData
+    def getDataStreamFromVectorField(self, vectorfieldPath, mode='r'):
+        """
+        Returns a memory-mapped (K, J, I, components) view of a vector field
+        written by blockmatching as Inrimage (.inr) or uncompressed NIfTI.
+        Nothing is read until the array is accessed, so large fields can be
+        inspected or downsampled (e.g. field[::4, ::4, ::4]) without loading
+        them into memory.
+        """
+        if vectorfieldPath.endswith('.inr'):
+            header = self.readInrimageHeader(vectorfieldPath)
+            shape = header['ZDIM'], header['YDIM'], header['XDIM'], header['VDIM']
+            return np.memmap(vectorfieldPath,
+                             dtype=header['dtype'],
+                             mode=mode,
+                             offset=header['size'],
+                             shape=shape)
+
+        elif vectorfieldPath.endswith('.nii'):
+            header = self.readNIFTIHeader(vectorfieldPath)
+            dim = header['dim']
+            numberOfDimensions = dim[0]
+            sizes = [max(1, n) for n in dim[1:numberOfDimensions + 1]]
+            sizes += [1] * (5 - len(sizes))  # I, J, K, T, components
+            dtype = np.dtype(NIFTI_DATA_TYPES[header['datatype']]).newbyteorder(header['endian'])
+            # NIfTI stores the components as the slowest axis
+            array = np.memmap(vectorfieldPath,
+                              dtype=dtype,
+                              mode=mode,
+                              offset=int(header['vox_offset']),
+                              shape=tuple(reversed(sizes)))
+            return array[:, 0].transpose(1, 2, 3, 0)
+
+        else:
+            raise ValueError('Cannot memory-map {}'.format(vectorfieldPath))
+
+
+    def readInrimageHeader(self, inrimagePath):
+        """
+        Parses the text header of an Inrimage file, which is a multiple of
+        256 bytes ending with "##}"
+        """
+        with open(inrimagePath, 'rb') as f:
+            text = b''
+            while b'##}' not in text:
+                block = f.read(INRIMAGE_HEADER_BLOCK)
+                if not block:
+                    raise IOError('Not an Inrimage file: {}'.format(inrimagePath))
+                text += block
+
+        header = {'size': len(text), 'VDIM': 1, 'ZDIM': 1}
+        for line in text.decode('ascii', 'replace').splitlines():
+            key, _, value = line.partition('=')
+            if value:
+                header[key.strip()] = value.strip()
+        for key in 'XDIM', 'YDIM', 'ZDIM', 'VDIM':
+            header[key] = int(header[key])
+
+        bits = int(header['PIXSIZE'].split()[0])
+        kind = {'float': 'f', 'unsigned fixed': 'u', 'signed fixed': 'i'}[header['TYPE']]
+        endian = '>' if header.get('CPU') in ('sun', 'sgi') else '<'
+        header['dtype'] = np.dtype('{}{}{}'.format(endian, kind, bits // 8))
+        return header
 
 
     def getNIFTIHeader(self, volumeNode):
-        reader = vtk.vtkNIFTIImageReader()
         filepath = self.getNodeFilepath(volumeNode)
-        reader.SetFileName(filepath)
-        reader.Update()
-        header = reader.GetNIFTIHeader()
+        return self.readNIFTIHeader(filepath)
+
+
+    def readNIFTIHeader(self, filepath):
+        """
+        Parses only the NIfTI-1 or NIfTI-2 header instead of reading the
+        whole image. Headers are cached until the file is modified.
+        """
+        if filepath.endswith('.img'):
+            filepath = filepath[:-4] + '.hdr'
+        elif filepath.endswith('.img.gz'):
+            filepath = filepath[:-7] + '.hdr.gz'
+
+        stat = os.stat(filepath)
+        key = filepath, stat.st_mtime, stat.st_size
+        if key not in self.niftiHeaderCache:
+            openFile = gzip.open if filepath.endswith('.gz') else open
+            with openFile(filepath, 'rb') as f:
+                data = f.read(540)
+            self.niftiHeaderCache[key] = self.parseNIFTIHeader(data)
+        return self.niftiHeaderCache[key]
+
+
+    def parseNIFTIHeader(self, data):
+        for endian in '<', '>':
+            sizeofHeader = struct.unpack(endian + 'i', data[:4])[0]
+            if sizeofHeader in (348, 540):
+                break
+        else:
+            raise IOError('Not a NIfTI header (sizeof_hdr is {})'.format(sizeofHeader))
+
+        def unpack(fmt, offset):
+            return struct.unpack_from(endian + fmt, data, offset)
+
+        header = {'version': 1 if sizeofHeader == 348 else 2, 'endian': endian}
+        if header['version'] == 1:
+            header['dim'] = unpack('8h', 40)
+            header['datatype'], header['bitpix'] = unpack('2h', 70)
+            header['pixdim'] = unpack('8f', 76)
+            header['vox_offset'] = unpack('f', 108)[0]
+            header['qform_code'], header['sform_code'] = unpack('2h', 252)
+        else:
+            header['datatype'], header['bitpix'] = unpack('2h', 12)
+            header['dim'] = unpack('8q', 16)
+            header['pixdim'] = unpack('8d', 104)
+            header['vox_offset'] = unpack('q', 168)[0]
+            header['qform_code'], header['sform_code'] = unpack('2i', 344)
         return header
 
 
     def getQFormAndSFormCodes(self, volumeNode):
+        """
+        Codes of the file that blockmatching will read. Nodes that need to be
+        exported are written by writeNIFTI with scanner codes.
+        """
+        if self.needsExport(volumeNode):
+            return NIFTI_XFORM_SCANNER_ANAT, NIFTI_XFORM_SCANNER_ANAT
         header = self.getNIFTIHeader(volumeNode)
-        qform_code = header.GetQFormCode()
-        sform_code = header.GetSFormCode()
+        qform_code = header['qform_code']
+        sform_code = header['sform_code']
         return qform_code, sform_code
 
 
     def getPyramidShapesMap(self, volumeNode):
+        if volumeNode is None: return None
+        imageData = volumeNode.GetImageData()
+        return self.getPyramidShapesMapFromShape(imageData.GetDimensions())
+
+
+    def getPyramidShapesMapFromShape(self, shape):
 
         def closestPowerofTwo(n):
             """
@@ -830,11 +2899,7 @@ class BlockmatchingLogic(ScriptedLoadableModuleLogic):
                 result = 2 ** np.floor(p)
             return int(result)
 
-        if volumeNode is None: return None
-
-        imageData = volumeNode.GetImageData()
-        shape = list(imageData.GetDimensions())
-
+        shape = list(shape)
         level = 0
         shapesMap = {level: shape}
 
@@ -847,12 +2912,113 @@ class BlockmatchingLogic(ScriptedLoadableModuleLogic):
             level += 1
             shapesMap[level] = newShape
 
-            if max(newShape) == 32:
+            if max(newShape) <= 32:  # images smaller than 32 would never stop
                 lastLevel = True
 
         return shapesMap
 
 
+    def getBlockCounts(self, shape, blockSize=BLOCK_SIZE, blockSpacing=BLOCK_SPACING,
+                       blockBorder=BLOCK_BORDER, searchHalfSize=SEARCH_NEIGHBORHOOD_HALF_SIZE,
+                       searchStep=SEARCH_NEIGHBORHOOD_STEP,
+                       floatingSelectionFraction=FLOATING_SELECTION_FRACTION):
+        """
+        Returns the number of floating blocks, the number of those that are
+        matched (the selection fraction keeps the ones with the highest
+        variance), the number of similarity evaluations and the voxels per block
+        """
+        numberOfBlocks = 1
+        positions = 1
+        blockVoxels = 1
+        for n, size, spacing, border, halfSize, step in zip(
+                shape, blockSize, blockSpacing, blockBorder, searchHalfSize, searchStep):
+            if n <= 1: continue  # 2D images
+            size = min(size, n)
+            available = max(size, n - 2 * border)
+            numberOfBlocks *= max(1, (available - size) // max(1, spacing) + 1)
+            positions *= 2 * (halfSize // max(1, step)) + 1
+            blockVoxels *= size
+        selectedBlocks = int(np.ceil(numberOfBlocks * floatingSelectionFraction))
+        return numberOfBlocks, selectedBlocks, selectedBlocks * positions, blockVoxels
+
+
+    def getLevelCost(self, shape, parameters=None):
+        """
+        Number of voxel comparisons of one block matching iteration
+        """
+        if parameters is None:
+            parameters = BlockmatchingParameters()
+        _, _, evaluations, blockVoxels = self.getBlockCounts(shape, **parameters.getBlockParameters())
+        return evaluations * blockVoxels
+
+
+    def getPyramidCosts(self, shape, parameters):
+        """
+        Returns {level: cost} for the levels of parameters. Levels that do not
+        exist for shape are ignored.
+        """
+        shapesMap = self.getPyramidShapesMapFromShape(shape)
+        costs = {}
+        for level in range(parameters.pyramidLowestLevel, parameters.pyramidHighestLevel + 1):
+            if level in shapesMap:
+                costs[level] = self.getLevelCost(shapesMap[level], parameters)
+        return costs
+
+
+    def getSecondsPerCost(self, trsfType=None):
+        """
+        Returns the median time per cost unit of the levels timed in the
+        history, preferring runs of the same transformation type, and the
+        number of runs used. The history is read again only if it changed.
+        """
+        historyPath = self.getHistoryPath()
+        mtime = os.path.getmtime(historyPath) if os.path.isfile(historyPath) else None
+        if self.secondsPerCostCache.get('mtime') != mtime:
+            ratios = {}
+            for record in self.readRunHistory():
+                levelCosts = record.get('levelCosts')
+                levelTimes = record.get('levels')
+                if record.get('status') != 'done' or not levelCosts or not levelTimes: continue
+                runRatios = [levelTimes[level] / levelCosts[level]
+                             for level in levelTimes if levelCosts.get(level)]
+                if not runRatios: continue
+                recordType = record.get('trsfType')
+                ratios.setdefault(recordType, []).append(np.median(runRatios))
+                ratios.setdefault(None, []).append(np.median(runRatios))
+            self.secondsPerCostCache = {'mtime': mtime, 'ratios': ratios}
+
+        ratios = self.secondsPerCostCache['ratios']
+        runRatios = ratios.get(trsfType) or ratios.get(None)
+        if not runRatios:
+            return DEFAULT_SECONDS_PER_COST, 0
+        return float(np.median(runRatios)), len(runRatios)
+
+
+    def predictLevelTimes(self, shape, parameters):
+        secondsPerCost = self.getSecondsPerCost(parameters.trsfType)[0]
+        costs = self.getPyramidCosts(shape, parameters)
+        return {level: cost * secondsPerCost for level, cost in costs.items()}
+
+
+    def planPyramidLevels(self, shape, timeBudget, parameters):
+        """
+        Returns (pyramidHighestLevel, pyramidLowestLevel). The highest level is
+        the coarsest one. Finer levels are added while the predicted time
+        fits in timeBudget seconds. The levels of parameters are ignored.
+        """
+        shapesMap = self.getPyramidShapesMapFromShape(shape)
+        highestLevel = max(shapesMap)
+        allLevels = parameters.copy(pyramidHighestLevel=highestLevel, pyramidLowestLevel=0)
+        times = self.predictLevelTimes(shape, allLevels)
+        lowestLevel = highestLevel
+        totalTime = times[highestLevel]
+        for level in range(highestLevel - 1, -1, -1):
+            totalTime += times[level]
+            if totalTime > timeBudget: break
+            lowestLevel = level
+        return highestLevel, lowestLevel
+
+
     def hasNiftiExtension(self, path):
         for ext in '.hdr', '.img', '.img.gz', '.nii', '.nii.gz':
             if path.endswith(ext):
@@ -871,14 +3037,87 @@ class BlockmatchingLogic(ScriptedLoadableModuleLogic):
 
 
     def isDouble(self, volumeNode):
+        if self.needsExport(volumeNode):
+            return volumeNode.GetImageData().GetScalarType() == vtk.VTK_DOUBLE
         header = self.getNIFTIHeader(volumeNode)
-        return header.GetDataType() == 64
+        return header['datatype'] == 64
 
 
     def getRange(self, volumeNode):
         if volumeNode is None: return None
+        statistics = self.getStatistics(volumeNode)
+        return statistics['min'], statistics['max']
+
+
+    def getStatistics(self, volumeNode):
+        """
+        Intensity statistics are computed once per volume and kept until its
+        image data is modified
+        """
+        nodeID = volumeNode.GetID()
+        if nodeID not in self.statisticsCache:
+            self.statisticsCache[nodeID] = self.computeStatistics(volumeNode)
+            self.observeImageData(volumeNode)
+        return self.statisticsCache[nodeID]
+
+
+    def computeStatistics(self, volumeNode, chunkVoxels=STATISTICS_CHUNK_VOXELS):
+        """
+        The range is computed by VTK and the histogram is accumulated over
+        slabs of the voxels array, so no temporary copy of the whole
+        volume is allocated
+        """
+        imageMin, imageMax = volumeNode.GetImageData().GetScalarRange()
         array = slicer.util.array(volumeNode.GetID())
-        return array.min(), array.max()
+        histogram = np.zeros(HISTOGRAM_BINS, np.int64)
+        sliceVoxels = max(1, array[0].size)
+        slicesPerChunk = max(1, chunkVoxels // sliceVoxels)
+        for start in range(0, len(array), slicesPerChunk):
+            chunk = array[start:start + slicesPerChunk]
+            chunkHistogram, binEdges = np.histogram(chunk, bins=HISTOGRAM_BINS, range=(imageMin, imageMax))
+            histogram += chunkHistogram
+        return dict(min=imageMin, max=imageMax, histogram=histogram, binEdges=binEdges)
+
+
+    def getPercentile(self, volumeNode, percentile):
+        """
+        Percentile interpolated linearly inside the corresponding histogram bin
+        """
+        statistics = self.getStatistics(volumeNode)
+        histogram = statistics['histogram']
+        binEdges = statistics['binEdges']
+        cumulative = np.cumsum(histogram)
+        target = percentile / 100. * cumulative[-1]
+        index = min(int(np.searchsorted(cumulative, target)), len(histogram) - 1)
+        previous = cumulative[index - 1] if index > 0 else 0
+        count = histogram[index]
+        fraction = float(target - previous) / count if count else 0
+        return binEdges[index] + fraction * (binEdges[index + 1] - binEdges[index])
+
+
+    def getPercentileThresholds(self, volumeNode, lowPercentile, highPercentile):
+        if volumeNode is None: return None
+        low = self.getPercentile(volumeNode, lowPercentile)
+        high = self.getPercentile(volumeNode, highPercentile)
+        return low, high
+
+
+    def observeImageData(self, volumeNode):
+        nodeID = volumeNode.GetID()
+        if nodeID in self.statisticsObservers: return
+
+        def onImageDataModified(caller, event):
+            self.statisticsCache.pop(caller.GetID(), None)
+
+        tag = volumeNode.AddObserver(slicer.vtkMRMLVolumeNode.ImageDataModifiedEvent, onImageDataModified)
+        self.statisticsObservers[nodeID] = volumeNode, tag
+
+
+    def removeStatisticsObservers(self):
+        for volumeNode, tag in self.statisticsObservers.values():
+            volumeNode.RemoveObserver(tag)
+        self.statisticsObservers = {}
+        self.statisticsCache = {}
 
 
     def getThresholdRange(self, volumeNode):
@@ -889,9 +3128,834 @@ class BlockmatchingLogic(ScriptedLoadableModuleLogic):
 
     def getNormalizedThresholds(self, volumeNode):
         if volumeNode is None: return None
-        imageMin, imageMax = np.array(self.getRange(volumeNode), np.float)
-        thresholds = np.array(self.getThresholdRange(volumeNode), np.float)
+        imageMin, imageMax = np.array(self.getRange(volumeNode), np.float64)
+        imageRange = imageMax - imageMin
+        if imageRange == 0: return 0, 255
+        thresholds = np.array(self.getThresholdRange(volumeNode), np.float64)
         thresholds -= imageMin
-        thresholds /= imageMax
+        thresholds /= imageRange
         thresholds *= 255
-        return tuple(thresholds.astype(np.uint8))
+        thresholds = np.clip(np.round(thresholds), 0, 255)
+        return tuple(int(t) for t in thresholds)
+
+
+
+class BlockmatchingParameters(object):
+    """
+    Options of a registration, independent of the GUI.
+    Thresholds are normalized to [0, 255] (see getNormalizedThresholds) and
+    parallelism is a dictionary of getParallelismArguments keyword
+    arguments. None means using the blockmatching defaults.
+    """
+
+    def __init__(self, trsfType='affine', pyramidHighestLevel=3, pyramidLowestLevel=2,
+                 gaussianFiltering=False, referenceThresholds=None, floatingThresholds=None,
+                 referenceRemovedFraction=None, floatingRemovedFraction=None,
+                 blockSize=None, blockSpacing=None, blockBorder=None,
+                 searchHalfSize=None, searchStep=None, floatingSelectionFraction=None,
+                 parallelism=None):
+        self.trsfType = trsfType.lower()
+        self.pyramidHighestLevel = pyramidHighestLevel
+        self.pyramidLowestLevel = pyramidLowestLevel
+        self.gaussianFiltering = gaussianFiltering
+        self.referenceThresholds = referenceThresholds
+        self.floatingThresholds = floatingThresholds
+        self.referenceRemovedFraction = referenceRemovedFraction
+        self.floatingRemovedFraction = floatingRemovedFraction
+        self.blockSize = blockSize
+        self.blockSpacing = blockSpacing
+        self.blockBorder = blockBorder
+        self.searchHalfSize = searchHalfSize
+        self.searchStep = searchStep
+        self.floatingSelectionFraction = floatingSelectionFraction
+        self.parallelism = parallelism
+
+
+    def __repr__(self):
+        return 'BlockmatchingParameters({})'.format(self.__dict__)
+
+
+    def copy(self, **changes):
+        parameters = BlockmatchingParameters()
+        parameters.__dict__.update(self.__dict__)
+        for key, value in changes.items():
+            if not hasattr(parameters, key):
+                raise AttributeError('Unknown parameter: {}'.format(key))
+            setattr(parameters, key, value)
+        return parameters
+
+
+    def isLinear(self):
+        return self.trsfType != 'vectorfield'
+
+
+    def getBlockParameters(self):
+        """
+        Block matching options with the blockmatching defaults filled in
+        """
+        def getValue(value, default):
+            return default if value is None else value
+
+        return dict(blockSize=getValue(self.blockSize, BLOCK_SIZE),
+                    blockSpacing=getValue(self.blockSpacing, BLOCK_SPACING),
+                    blockBorder=getValue(self.blockBorder, BLOCK_BORDER),
+                    searchHalfSize=getValue(self.searchHalfSize, SEARCH_NEIGHBORHOOD_HALF_SIZE),
+                    searchStep=getValue(self.searchStep, SEARCH_NEIGHBORHOOD_STEP),
+                    floatingSelectionFraction=getValue(self.floatingSelectionFraction,
+                                                       FLOATING_SELECTION_FRACTION))
+
+
+
+class BlockmatchingEngine(object):
+    """
+    Runs one registration: exports the inputs, builds the command line, runs
+    blockmatching in a QProcess, validates the outputs and loads the results.
+    It does not depend on the GUI, so it can be used from scripts, with
+    --no-main-window or concurrently (see BlockmatchingBatch).
+
+    Example:
+    >>> logic = BlockmatchingLogic()
+    >>> parameters = BlockmatchingParameters(trsfType='rigid')
+    >>> engine = BlockmatchingEngine(logic, referenceNode, floatingNode, parameters)
+    >>> if engine.run() == 'done':
+    ...     transformNode = engine.loadResultTransform()
+    """
+
+    def __init__(self, logic, reference, floating, parameters=None,
+                 initialTransform=None, outputDirectory=None, useCache=True):
+        self.logic = logic
+        self.reference = reference
+        self.floating = floating
+        self.parameters = parameters if parameters is not None else BlockmatchingParameters()
+        self.initialTransform = initialTransform
+        self.outputDirectory = outputDirectory
+        self.useCache = useCache
+        self.exclusiveProcess = True  # no other child process is expected to finish meanwhile
+        self.resultVolumeNode = None  # nodes the widget loads the results into
+        self.resultTransformNode = None
+        self.requireResultVolume = True  # otherwise only the transform is needed
+        self.roi = None  # markups ROI or segmentation used to crop the inputs
+        self.previewLevel = None  # if set, the inputs are downsampled to this pyramid level
+        self.roiMargin = ROI_DEFAULT_MARGIN_MM
+        self.referenceCropExtent = None
+        self.referenceDimensions = None
+
+        self.status = 'pending'  # pending, running, done, failed or cancelled
+        self.commandLineList = None
+        self.registrationKey = None
+        self.referencePath = None
+        self.floatingPath = None
+        self.resultPath = None
+        self.resultTransformPath = None
+        self.initialTransformPath = None
+        self.cmdPath = None
+        self.logPath = None
+        self.displacementFieldPath = None
+
+        self.process = None
+        self.monitor = None
+        self.cancelled = False
+        # Complete lines only, the oldest ones are dropped from the buffers
+        self.stdout = collections.deque(maxlen=LOG_MAX_LINES)
+        self.stderr = collections.deque(maxlen=LOG_MAX_LINES)
+        self.partialLines = {'stdout': '', 'stderr': '', 'log': ''}
+        self.logTimer = None
+        self.logOffset = 0
+        self.level = None
+        self.iteration = None
+        self.returnCode = None
+        self.record = None
+        self.historyDeferred = False  # set by onFinished to call writeHistory later
+        self.historyWritten = False
+        self.startTime = None
+        self.elapsedTime = None
+        self.onFinished = None
+        self.onOutput = None
+        self.onProgress = None
+        self.eventLoop = None
+
+
+    def __repr__(self):
+        return '{}({}, {}, {})'.format(type(self).__name__, self.reference, self.floating, self.status)
+
+
+    def prepare(self):
+        """
+        Makes sure that the inputs are on the disk and builds the command line
+        """
+        logic = self.logic
+        if self.outputDirectory is None:
+            self.outputDirectory = str(slicer.util.tempDirectory())
+        directory = self.outputDirectory
+        trsfType = self.parameters.trsfType
+        dateTime = datetime.datetime.now()
+        self.record = logic.newRunRecord()
+        if self.previewLevel is not None:
+            # Levels are given for the full images
+            levelsChanges = dict(
+                pyramidHighestLevel=max(0, self.parameters.pyramidHighestLevel - self.previewLevel),
+                pyramidLowestLevel=max(0, self.parameters.pyramidLowestLevel - self.previewLevel))
+            self.parameters = self.parameters.copy(**levelsChanges)
+
+        with logic.timePhase(self.record, 'export'):
+            refName = logic.getVolumeName(self.reference)
+            floName = logic.getVolumeName(self.floating)
+
+            if self.previewLevel is not None:
+                self.referencePath = logic.exportDownsampledVolume(
+                    self.reference, self.previewLevel, directory, dateTime=dateTime)
+                self.floatingPath = logic.exportDownsampledVolume(
+                    self.floating, self.previewLevel, directory, dateTime=dateTime)
+                self.record['preview'] = True
+            elif self.roi is None:
+                self.referencePath = logic.getVolumePathOnDisk(self.reference, directory, dateTime=dateTime)
+                self.floatingPath = logic.getVolumePathOnDisk(self.floating, directory, dateTime=dateTime)
+            else:
+                self.referencePath = self.exportCroppedInput(self.reference, directory, dateTime)
+                self.floatingPath = self.exportCroppedInput(self.floating, directory, dateTime)
+                self.referenceCropExtent = logic.getCropExtent(self.reference, self.roi, self.roiMargin)
+                self.referenceDimensions = self.reference.GetImageData().GetDimensions()
+
+            self.resultPath = logic.getTempPath(directory,
+                                                logic.getImageExtension(),
+                                                filename='{}_on_{}'.format(floName, refName),
+                                                dateTime=dateTime)
+
+            trsfExtension = '.trsf' if self.parameters.isLinear() else logic.getImageExtension()
+            self.resultTransformPath = logic.getTempPath(directory,
+                                                         trsfExtension,
+                                                         filename='t_ref-{}_flo-{}'.format(refName, floName),
+                                                         dateTime=dateTime)
+
+            # Save the command line for debugging
+            self.cmdPath = logic.getTempPath(directory,
+                                             '.txt',
+                                             filename='cmd_ref-{}_flo-{}_{}'.format(refName, floName, trsfType),
+                                             dateTime=dateTime)
+            self.logPath = logic.getTempPath(directory,
+                                             '.txt',
+                                             filename='log_ref-{}_flo-{}_{}'.format(refName, floName, trsfType),
+                                             dateTime=dateTime)
+
+            self.displacementFieldPath = logic.getTempPath(
+                directory, '.nii',
+                filename='disp_field_ref-{}_flo-{}_{}'.format(refName, floName, trsfType),
+                dateTime=dateTime)
+
+            if isinstance(self.initialTransform, str):
+                self.initialTransformPath = self.initialTransform
+            elif self.initialTransform is not None:
+                self.initialTransformPath = logic.getTempPath(directory, '.trsf', dateTime=dateTime)
+                logic.writeBaladinMatrix(self.initialTransform, self.initialTransformPath)
+
+        # Used to calibrate the pyramid levels planner
+        dim = logic.readNIFTIHeader(self.referencePath)['dim']
+        referenceShape = [dim[i] if i <= dim[0] else 1 for i in (1, 2, 3)]
+        levelCosts = logic.getPyramidCosts(referenceShape, self.parameters)
+        self.record['levelCosts'] = {str(level): cost for level, cost in levelCosts.items()}
+        self.record['trsfType'] = self.parameters.trsfType
+
+        self.commandLineList = logic.makeCommandLineList(self.referencePath,
+                                                         self.floatingPath,
+                                                         self.resultPath,
+                                                         self.resultTransformPath,
+                                                         self.parameters,
+                                                         initialTransformPath=self.initialTransformPath,
+                                                         cmdPath=self.cmdPath,
+                                                         logPath=self.logPath)
+
+
+    def exportCroppedInput(self, volumeNode, directory, dateTime):
+        if isinstance(volumeNode, str):
+            raise ValueError('Only volume nodes can be cropped: {}'.format(volumeNode))
+        extent = self.logic.getCropExtent(volumeNode, self.roi, self.roiMargin)
+        return self.logic.exportCroppedVolume(volumeNode, extent, directory, dateTime=dateTime)
+
+
+    def printCommandLine(self):
+        """
+        Pretty-prints the command line so that it can be copied from the Python
+        console and pasted on a terminal.
+        """
+        prettyCmd = []
+        for s in self.commandLineList:
+            if s.startswith('-'):
+                prettyCmd.append('\\\n')
+            prettyCmd.append(s)
+        print(' '.join(prettyCmd))
+
+
+    def start(self, onFinished=None, onOutput=None, onProgress=None):
+        """
+        Runs blockmatching without blocking the event loop. If the results
+        are cached, no process is run.
+        onFinished is called with the engine when the registration finishes.
+        onOutput is called with each line and its stream (stdout, stderr or
+        log) as soon as it is written. onProgress is called with the engine
+        when the current pyramid level or iteration changes.
+        """
+        self.onFinished = onFinished
+        self.onOutput = onOutput
+        self.onProgress = onProgress
+        self.startTime = time.time()  # reset below, after the inputs are prepared
+        try:
+            if self.commandLineList is None:
+                self.prepare()
+            if self.useCache:
+                self.registrationKey = self.logic.getRegistrationKey(self.commandLineList)
+                cachedResults = self.logic.getCachedResults(self.registrationKey)
+            else:
+                cachedResults = None
+        except Exception as e:  # e.g. inputs could not be exported
+            self.stderr.append(str(e) + '\n')
+            self.finish('failed')
+            return
+
+        # The export and the hashing of the inputs are not timed as the process
+        self.startTime = time.time()
+        if cachedResults is not None and (cachedResults[0] is not None or not self.requireResultVolume):
+            print('Loading cached results')
+            self.resultPath, self.resultTransformPath = cachedResults
+            self.record['cached'] = True
+            self.finish('done')
+            return
+
+        self.process = qt.QProcess()
+        self.process.readyReadStandardOutput.connect(self.onProcessStdout)
+        self.process.readyReadStandardError.connect(self.onProcessStderr)
+        self.process.finished.connect(self.onProcessFinished)
+        self.process.errorOccurred.connect(self.onProcessError)
+        self.monitor = ProcessMonitor(self.process, exclusive=self.exclusiveProcess)
+
+        # The logfile is written by blockmatching, so it is polled
+        self.logTimer = qt.QTimer()
+        self.logTimer.setInterval(MONITOR_INTERVAL_MS)
+        self.logTimer.timeout.connect(self.readLogFile)
+        self.logTimer.start()
+
+        self.status = 'running'
+        self.process.start(self.commandLineList[0], self.commandLineList[1:])
+
+
+    def run(self):
+        """
+        Runs blockmatching and waits until it finishes, processing Qt events
+        meanwhile. Returns the final status.
+        """
+        self.start()
+        self.wait()
+        return self.status
+
+
+    def wait(self):
+        if self.status != 'running': return
+        self.eventLoop = qt.QEventLoop()
+        self.eventLoop.exec_()
+        self.eventLoop = None
+
+
+    def cancel(self):
+        if self.process is None: return
+        self.cancelled = True
+        self.process.kill()
+
+
+    def isRunning(self):
+        return self.status == 'running'
+
+
+    def getErrorMessage(self, maxLines=LOG_DIALOG_LINES):
+        """
+        Last lines of stderr, short enough to be shown in a dialog
+        """
+        lines = list(self.stderr)
+        if len(lines) > maxLines:
+            lines = ['[{} lines omitted]\n'.format(len(lines) - maxLines)] + lines[-maxLines:]
+        return ''.join(lines)
+
+
+    def onProcessStdout(self):
+        text = self.logic.decodeProcessOutput(self.process.readAllStandardOutput())
+        for line in self.splitLines('stdout', text):
+            self.stdout.append(line)
+            self.onLine(line, 'stdout')
+
+
+    def onProcessStderr(self):
+        text = self.logic.decodeProcessOutput(self.process.readAllStandardError())
+        for line in self.splitLines('stderr', text):
+            self.stderr.append(line)
+            self.onLine(line, 'stderr')
+
+
+    def readLogFile(self):
+        if self.logPath is None or not os.path.isfile(self.logPath): return
+        with open(self.logPath, 'rb') as f:
+            f.seek(self.logOffset)
+            data = f.read()
+        self.logOffset += len(data)
+        for line in self.splitLines('log', data.decode('utf-8', 'replace')):
+            self.onLine(line, 'log')
+
+
+    def splitLines(self, stream, text, flush=False):
+        """
+        Returns the complete lines, keeping the last partial line of each
+        stream until the rest of it is read
+        """
+        lines = (self.partialLines[stream] + text).splitlines(True)
+        self.partialLines[stream] = ''
+        if lines and not lines[-1].endswith('\n') and not flush:
+            self.partialLines[stream] = lines.pop()
+        return lines
+
+
+    def onLine(self, line, stream):
+        if self.onOutput is not None:
+            self.onOutput(line, stream)
+        level, iteration = self.logic.parseProgressLine(line)
+        if level is None and iteration is None: return
+        if level is not None and level != self.level:
+            self.level = level
+            self.iteration = None
+        if iteration is not None:
+            self.iteration = iteration
+        if self.onProgress is not None:
+            self.onProgress(self)
+
+
+    def stopStreaming(self):
+        """
+        Reads what is left of the logfile and flushes the partial lines
+        """
+        if self.logTimer is None: return
+        self.logTimer.stop()
+        self.logTimer = None
+        self.readLogFile()
+        for stream, lines in ('stdout', self.stdout), ('stderr', self.stderr), ('log', None):
+            for line in self.splitLines(stream, '', flush=True):
+                if lines is not None:
+                    lines.append(line)
+                self.onLine(line, stream)
+
+
+    def onProcessError(self, error):
+        if error != qt.QProcess.FailedToStart: return
+        self.stderr.append(self.process.errorString() + '\n')
+        self.stderr.append('Is blockmatching correctly installed?\n')
+        self.process = None
+        self.monitor.stop()
+        self.stopStreaming()
+        self.finish('failed')
+
+
+    def onProcessFinished(self, exitCode, exitStatus):
+        self.process = None
+        self.returnCode = exitCode
+        self.record['phases']['process'] = time.time() - self.startTime
+        self.record['returnCode'] = exitCode
+        self.record.update(self.monitor.stop())
+        self.stopStreaming()
+
+        if self.cancelled:
+            status = 'cancelled'
+        elif exitStatus != qt.QProcess.NormalExit or exitCode != 0:
+            status = 'failed'
+        elif not self.outputsExist():
+            # Newer versions of blockmatching return 0
+            # Apparently it always returns 0 :(
+            self.stderr.append('Output volume not written on the disk\n')
+            status = 'failed'
+        else:
+            status = 'done'
+            self.repareResults()
+            if self.useCache:
+                self.logic.cacheResults(self.registrationKey, self.resultPath, self.resultTransformPath)
+        self.finish(status)
+
+
+    def finish(self, status):
+        """
+        The run is recorded in the history after onFinished, so that it can
+        time the loading of the results. If onFinished sets historyDeferred,
+        writeHistory must be called once the record is complete.
+        """
+        self.status = status
+        self.elapsedTime = time.time() - self.startTime
+        if self.onFinished is not None:
+            self.onFinished(self)
+        if self.record is not None:
+            self.logic.finishRunRecord(self.record, self.commandLineList, status,
+                                       logPath=self.logPath, output=self.stdout,
+                                       append=not self.historyDeferred)
+            self.historyWritten = not self.historyDeferred
+        if self.eventLoop is not None:
+            self.eventLoop.quit()
+
+
+    def writeHistory(self):
+        if self.record is None or self.historyWritten: return
+        self.logic.appendRunHistory(self.record)
+        self.historyWritten = True
+
+
+    def removeIntermediateFiles(self, removeInputs=True):
+        """
+        Removes the exported inputs, the command line, the log and the
+        outputs once the results have been loaded. Cached results are kept.
+        Inputs shared with other running registrations must be kept.
+        """
+        for path in self.referencePath, self.floatingPath:
+            if path is not None and removeInputs:
+                self.logic.removeExportedFile(path)
+        paths = [self.cmdPath, self.logPath, self.resultPath, self.resultTransformPath]
+        if self.initialTransformPath is not None and not isinstance(self.initialTransform, str):
+            paths.append(self.initialTransformPath)
+        cacheDir = self.logic.getResultCacheDirectory()
+        for path in paths:
+            if path is None or path.startswith(cacheDir): continue
+            if os.path.isfile(path):
+                os.remove(path)
+
+
+    def outputsExist(self):
+        """
+        We need this because it's not clear that blockmatching returns non-zero
+        when failed
+        """
+        if self.requireResultVolume and not os.path.isfile(self.resultPath):
+            return False
+        return os.path.isfile(self.resultTransformPath)
+
+
+    def repareResults(self):
+        """
+        This is used to convert output .hdr Analyze into NIfTI
+        """
+        if self.resultPath.endswith('.hdr'):
+            print('Correcting result .hdr image')
+            shutil.copy(self.referencePath, self.resultPath)
+
+
+    def loadResultTransform(self, name=None, transformNode=None):
+        return self.logic.loadResultTransform(self.resultTransformPath,
+                                              self.parameters.trsfType,
+                                              name=name,
+                                              cropExtent=self.referenceCropExtent,
+                                              dimensions=self.referenceDimensions,
+                                              transformNode=transformNode)
+
+
+
+class ProcessMonitor(object):
+    """
+    Samples the peak resident memory and the CPU time of a QProcess from
+    /proc while it runs (Linux only).
+    If exclusive is True, i.e. no other child process finishes meanwhile,
+    the CPU time is read from rusage instead, which is exact. Runs that
+    overlap another monitored process, e.g. a preview, a cancelled process
+    not reaped yet or a batch job, are never considered exclusive.
+    """
+
+    running = set()  # monitors whose process has not finished yet
+
+    def __init__(self, process, exclusive=False):
+        self.process = process
+        self.exclusive = exclusive
+        self.overlapped = bool(ProcessMonitor.running)
+        for monitor in ProcessMonitor.running:
+            monitor.overlapped = True
+        ProcessMonitor.running.add(self)
+        self.pid = None
+        self.peakRSS = None
+        self.cpuTime = None
+        self.childrenUsage = self.getChildrenUsage()
+        self.timer = qt.QTimer()
+        self.timer.setInterval(MONITOR_INTERVAL_MS)
+        self.timer.timeout.connect(self.sample)
+        process.started.connect(self.onStarted)
+
+
+    def onStarted(self):
+        self.pid = self.process.processId()
+        self.sample()
+        self.timer.start()
+
+
+    def getChildrenUsage(self):
+        if resource is None: return None
+        return resource.getrusage(resource.RUSAGE_CHILDREN)
+
+
+    def sample(self):
+        procDir = '/proc/{}'.format(self.pid)
+        try:
+            with open(os.path.join(procDir, 'status')) as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        self.peakRSS = int(line.split()[1]) * 1024  # kB
+            with open(os.path.join(procDir, 'stat')) as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+            ticksPerSecond = float(os.sysconf('SC_CLK_TCK'))
+            self.cpuTime = (int(fields[11]) + int(fields[12])) / ticksPerSecond
+        except (IOError, OSError, ValueError, IndexError, AttributeError):
+            pass  # the process has finished or there is no /proc
+
+
+    def stop(self):
+        self.timer.stop()
+        ProcessMonitor.running.discard(self)
+        cpuTime = self.cpuTime
+        if self.exclusive and not self.overlapped and self.childrenUsage is not None:
+            before = self.childrenUsage
+            after = self.getChildrenUsage()
+            cpuTime = (after.ru_utime + after.ru_stime) - (before.ru_utime + before.ru_stime)
+        return {'peakRSSBytes': self.peakRSS, 'cpuSeconds': cpuTime}
+
+
+
+class RegistrationJob(BlockmatchingEngine):
+    """
+    A reference/floating pair to be registered in a batch.
+    Reference and floating can be volume nodes or paths to NIfTI files.
+    Initial transform can be a linear transform node or a .trsf path.
+    The batch sets its logic, parameters and output directory.
+    """
+
+    def __init__(self, reference, floating, initialTransform=None):
+        BlockmatchingEngine.__init__(self, None, reference, floating, initialTransform=initialTransform)
+        self.requireResultVolume = False
+        self.parallelism = None  # overrides the batch parallelism if not None
+
+
+
+class BlockmatchingBatch(object):
+    """
+    Queue of registration jobs run on a bounded pool of blockmatching
+    processes. Processes are QProcess instances, so the event loop is never
+    blocked and jobs can be loaded into the scene as soon as they finish.
+    """
+
+    def __init__(self, logic, jobs, parameters=None, maxProcesses=None,
+                 outputDirectory=None, loadResults=True, onJobFinished=None,
+                 onFinished=None, useCache=True):
+        self.logic = logic
+        self.jobs = list(jobs)
+        self.parameters = parameters if parameters is not None else BlockmatchingParameters()
+        self.loadResults = loadResults
+        self.onJobFinished = onJobFinished
+        self.onFinished = onFinished
+        self.useCache = useCache
+
+        if outputDirectory is None:
+            outputDirectory = str(slicer.util.tempDirectory())
+        self.outputDirectory = outputDirectory
+
+        numberOfCores = self.logic.getNumberOfCores()
+        if maxProcesses is None:
+            maxProcesses = self.logic.getBatchPoolSize(len(self.jobs), numberOfCores)
+        self.maxProcesses = max(1, maxProcesses)
+        self.maxChunks = self.logic.getChunksPerProcess(self.maxProcesses, numberOfCores)
+
+        self.pendingJobs = list(self.jobs)
+        self.runningJobs = []
+        self.cancelled = False
+        self.finished = False
+        self.eventLoop = None
+
+
+    def start(self):
+        print('Running {} jobs on {} processes with {} chunks each'.format(
+            len(self.jobs), self.maxProcesses, self.maxChunks))
+        self.fillPool()
+
+
+    def wait(self):
+        """
+        Blocks until all the jobs are finished, processing Qt events meanwhile.
+        Useful when running batches from the Python console or from scripts.
+        """
+        if self.finished: return
+        self.eventLoop = qt.QEventLoop()
+        self.eventLoop.exec_()
+        self.eventLoop = None
+
+
+    def cancel(self):
+        self.cancelled = True
+        for job in self.pendingJobs:
+            job.status = 'cancelled'
+        self.pendingJobs = []
+        for job in list(self.runningJobs):
+            job.cancel()
+
+
+    def isRunning(self):
+        return not self.finished
+
+
+    def getNumberOfFinishedJobs(self):
+        return len([job for job in self.jobs if job.status in ('done', 'failed', 'cancelled')])
+
+
+    def getJobParameters(self, job):
+        """
+        Each process gets maxChunks chunks so that the pool does not
+        oversubscribe the cores, unless a parallelism was given. A single job
+        cannot oversubscribe them, so it keeps the blockmatching defaults.
+        """
+        parallelism = job.parallelism
+        if parallelism is None:
+            parallelism = self.parameters.parallelism
+        if parallelism is None and len(self.jobs) > 1:
+            parallelism = dict(maxChunks=self.maxChunks)
+        return self.parameters.copy(parallelism=parallelism)
+
+
+    def fillPool(self):
+        while self.pendingJobs and len(self.runningJobs) < self.maxProcesses:
+            job = self.pendingJobs.pop(0)
+            self.startJob(job)
+        if not self.pendingJobs and not self.runningJobs and not self.finished:
+            self.finish()
+
+
+    def startJob(self, job):
+        job.logic = self.logic
+        job.parameters = self.getJobParameters(job)
+        job.outputDirectory = self.outputDirectory
+        job.useCache = self.useCache
+        job.exclusiveProcess = self.maxProcesses == 1
+        self.runningJobs.append(job)
+        job.start(onFinished=self.onJobEngineFinished)
+
+
+    def onJobEngineFinished(self, job):
+        self.runningJobs.remove(job)
+        if self.cancelled and job.status != 'done':
+            job.status = 'cancelled'
+
+        if job.status == 'done' and self.loadResults:
+            with self.logic.timePhase(job.record, 'loading'):
+                name = 't_ref-{}_flo-{}'.format(self.logic.getVolumeName(job.reference),
+                                                self.logic.getVolumeName(job.floating))
+                # Rerunning a batch updates the transforms of the previous run
+                previousNode = slicer.mrmlScene.GetFirstNodeByName(name)
+                job.resultTransformNode = job.loadResultTransform(name=name, transformNode=previousNode)
+            if self.logic.getCleanupIntermediates():
+                # Other jobs might use the same inputs, they are removed in finish()
+                qt.QTimer.singleShot(0, lambda job=job: job.removeIntermediateFiles(removeInputs=False))
+
+        print('[{}/{}] {}'.format(self.getNumberOfFinishedJobs(), len(self.jobs), job))
+        if job.status == 'failed':
+            print(''.join(job.stderr))
+        if self.onJobFinished is not None:
+            self.onJobFinished(job)
+
+        # Jobs might finish while they are started, e.g. if cached
+        qt.QTimer.singleShot(0, self.fillPool)
+
+
+    def finish(self):
+        self.finished = True
+        if self.loadResults and self.logic.getCleanupIntermediates():
+            for job in self.jobs:
+                if job.status == 'done':
+                    job.removeIntermediateFiles()
+        if self.onFinished is not None:
+            self.onFinished(self)
+        if self.eventLoop is not None:
+            self.eventLoop.quit()
+
+
+
+class BlockmatchingCascade(object):
+    """
+    Runs a sequence of registrations of the same pair, e.g. rigid, affine
+    and vectorfield. Each stage is a single job batch initialized with the
+    result transformation of the previous one.
+    """
+
+    def __init__(self, logic, reference, floating, stages, parameters=None,
+                 initialTransform=None, roi=None, roiMargin=ROI_DEFAULT_MARGIN_MM,
+                 requireResultVolume=False, onStageFinished=None, onFinished=None,
+                 **batchParameters):
+        for trsfType, _, _ in stages[:-1]:
+            if not logic.isLinear(trsfType):
+                raise ValueError('Only the last stage of a cascade can be non-linear')
+        self.logic = logic
+        self.reference = reference
+        self.floating = floating
+        self.stages = stages
+        self.parameters = parameters if parameters is not None else BlockmatchingParameters()
+        self.initialTransform = initialTransform
+        self.roi = roi
+        self.roiMargin = roiMargin
+        self.requireResultVolume = requireResultVolume
+        self.onStageFinished = onStageFinished
+        self.onFinished = onFinished
+        self.batchParameters = batchParameters
+
+        self.jobs = []
+        self.batch = None
+        self.cancelled = False
+        self.eventLoop = None
+
+
+    def start(self):
+        self.runStage(0, self.initialTransform)
+
+
+    def wait(self):
+        if not self.isRunning(): return
+        self.eventLoop = qt.QEventLoop()
+        self.eventLoop.exec_()
+        self.eventLoop = None
+
+
+    def cancel(self):
+        self.cancelled = True
+        if self.batch is not None:
+            self.batch.cancel()
+
+
+    def isRunning(self):
+        return self.batch is not None
+
+
+    def runStage(self, index, initialTransform):
+        trsfType, pyramidHighestLevel, pyramidLowestLevel = self.stages[index]
+        print('Cascade stage {}/{}: {}, levels {} to {}'.format(
+            index + 1, len(self.stages), trsfType, pyramidHighestLevel, pyramidLowestLevel))
+        parameters = self.parameters.copy(trsfType=trsfType,
+                                          pyramidHighestLevel=pyramidHighestLevel,
+                                          pyramidLowestLevel=pyramidLowestLevel)
+        job = RegistrationJob(self.reference, self.floating, initialTransform=initialTransform)
+        job.roi = self.roi
+        job.roiMargin = self.roiMargin
+        if index == len(self.stages) - 1:
+            job.requireResultVolume = self.requireResultVolume
+        self.jobs.append(job)
+        self.batch = self.logic.registerBatch([job],
+                                              parameters=parameters,
+                                              maxProcesses=1,
+                                              loadResults=False,
+                                              onFinished=self.onBatchFinished,
+                                              **self.batchParameters)
+
+
+    def onBatchFinished(self, batch):
+        job = batch.jobs[0]
+        if self.onStageFinished is not None:
+            self.onStageFinished(job)
+
+        nextIndex = len(self.jobs)
+        if job.status == 'done' and not self.cancelled and nextIndex < len(self.stages):
+            # With -composition-with-initial, the result includes the initial transformation
+            self.runStage(nextIndex, job.resultTransformPath)
+        else:
+            self.batch = None
+            if self.onFinished is not None:
+                self.onFinished(self)
+            if self.eventLoop is not None:
+                self.eventLoop.quit()